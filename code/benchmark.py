@@ -0,0 +1,312 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from geojson_io import write_features
+from matrix_io import read_matrix
+from run_report import report_file
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser() # Times the pipeline on synthetic networks
+parser.add_argument('--outfile', '-o', help='Set output location of the results (.json)', type=str, default='output/benchmark.json')
+parser.add_argument('--edges', '-n', help='Number of road lines of each synthetic network', type=int, nargs='+', default=[1000, 10000])
+parser.add_argument('--cities', '-c', help='Number of cities of each synthetic network (one value for all, or one per --edges)', type=int, nargs='+', default=[100, 1000])
+parser.add_argument('--engines', '-e', help='Routing engines to time', choices=['networkx', 'csr', 'overlay'], nargs='+', default=['csr'])
+parser.add_argument('--workers', '-w', help='Number of processes for each cost matrix', type=int, default=1)
+parser.add_argument('--contract', help='Route on the contracted network (get_cost_matrix.py --contract)', action='store_true')
+parser.add_argument('--matrix_format', help='Set format of the cost matrices', choices=['npy', 'csv', 'parquet'], default='npy')
+parser.add_argument('--seed', help='Set random seed of the synthetic networks', type=int, default=0)
+parser.add_argument('--workdir', help='Give folder for the synthetic inputs and outputs (default: a temporary folder, removed at the end)', type=str)
+args = parser.parse_args()
+
+# 0. Set assumptions and file names
+#---------------------------------------------------
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+PARAMETER_DIR = 'parameters'
+COUNTRIES = [['CIV', 'GHA', 'NGA'], ['MLI', 'BFA', 'NER']] # Blocks of the synthetic map, south to north
+STEP = 0.05 # Degrees between neighbouring road nodes
+JITTER = 0.01 # So roads are not all the same length
+DROP = 0.2 # Share of grid lines without a road
+QUALITIES, QUALITY_SHARES = [1, 2, 3, 4], [0.1, 0.2, 0.4, 0.3]
+N_PORTS = 8
+FEE_FACTOR = 10 # Border costs of the fee scenario, times the shipped ones
+METERS_PER_DEGREE = 111000
+
+# Numbered step banners logged by the scripts, e.g. '1. Reading GeoJSONs...'
+STAGE_PATTERN = re.compile(r'^\w+:[\w.]+:(\d+b?\. .*?)\.*$')
+SIZE_PATTERN = re.compile(r'# of nodes: (\d+), # of edges: (\d+)')
+
+if len(args.cities) not in (1, len(args.edges)):
+    parser.error('Give one --cities value, or one for each --edges value.')
+SCALES = list(zip(args.edges, args.cities * len(args.edges) if len(args.cities) == 1 else args.cities))
+#---------------------------------------------------
+
+
+# 1. Make synthetic inputs
+#---------------------------------------------------
+def make_roads(n_lines, rng):
+    # A jittered grid of road nodes, split into blocks of COUNTRIES. Lines
+    #  run between neighbouring nodes and belong to the block they are in,
+    #  so nodes on the edge of a block are shared by the countries on both
+    #  sides (a border crossing, with 3 or 4 countries at block corners).
+    #  Returns the node coordinates and the features.
+    rows, cols = len(COUNTRIES), len(COUNTRIES[0])
+    m = max(1, int(round(np.sqrt(n_lines / (2*rows*cols*(1-DROP)))))) # Grid cells per block side
+    grid = np.stack(np.meshgrid(np.arange(cols*m+1), np.arange(rows*m+1), indexing='ij'), axis=-1)
+    xy = np.round(grid*STEP + rng.uniform(-JITTER, JITTER, size=grid.shape), 6)
+
+    i, j = [a.ravel() for a in np.meshgrid(np.arange(cols*m), np.arange(rows*m+1), indexing='ij')]
+    k, l = [a.ravel() for a in np.meshgrid(np.arange(cols*m+1), np.arange(rows*m), indexing='ij')]
+    start = np.concatenate([np.column_stack([i, j]), np.column_stack([k, l])])
+    end = np.concatenate([np.column_stack([i+1, j]), np.column_stack([k, l+1])])
+    block_x = np.minimum(start[:, 0] // m, cols-1)
+    block_y = np.minimum(start[:, 1] // m, rows-1)
+
+    keep = rng.random(len(start)) >= DROP
+    start, end, block_x, block_y = start[keep], end[keep], block_x[keep], block_y[keep]
+    p, q = xy[start[:, 0], start[:, 1]], xy[end[:, 0], end[:, 1]]
+    length = np.hypot(*(q - p).T) * METERS_PER_DEGREE * rng.uniform(1, 1.3, size=len(p)) # Roads wind a little
+    quality = rng.choice(QUALITIES, size=len(p), p=QUALITY_SHARES)
+
+    features = ({
+        'type': 'Feature',
+        'properties': {'iso3': COUNTRIES[by][bx], 'length': float(d), 'quality': int(c)},
+        'geometry': {'type': 'MultiLineString', 'coordinates': [[a.tolist(), b.tolist()]]},
+        } for a, b, bx, by, d, c in zip(p, q, block_x, block_y, length, quality))
+    return xy, features
+
+
+def make_sea(xy):
+    # Ports on road nodes along the south coast, linked one after the
+    #  other by sea. Sea links end just off the port, so they are never
+    #  mistaken for a border crossing.
+    columns = np.unique(np.linspace(0, xy.shape[0]-1, N_PORTS).astype(int))
+    ports = xy[columns, 0]
+    ends = ports - [0, 2*JITTER]
+    sea = [{
+        'type': 'Feature',
+        'properties': {'iso3': 'sea', 'length': float(np.hypot(*(b - a)) * METERS_PER_DEGREE), 'quality': 'sea'},
+        'geometry': {'type': 'MultiLineString', 'coordinates': [[a.tolist(), b.tolist()]]},
+        } for a, b in zip(ends[:-1], ends[1:])]
+    ports = [{'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Point', 'coordinates': a.tolist()}} for a in ports]
+    return sea, ports
+
+
+def make_fragment():
+    # Two CIV roads west of the grid that connect to nothing, with a city
+    #  on them. Real OSM data always has such fragments, and every other
+    #  city must be unreachable from it.
+    x, y = -10*STEP, STEP
+    points = [[x, y], [x + STEP, y], [x + 2*STEP, y]]
+    roads = [{
+        'type': 'Feature',
+        'properties': {'iso3': 'CIV', 'length': STEP * METERS_PER_DEGREE, 'quality': 4},
+        'geometry': {'type': 'MultiLineString', 'coordinates': [[a, b]]},
+        } for a, b in zip(points[:-1], points[1:])]
+    return roads, points[1]
+
+
+def make_cities(n_cities, xy, rng):
+    # Cities anywhere on the map, with the country of their block
+    rows, cols = len(COUNTRIES), len(COUNTRIES[0])
+    width, height = (np.array(xy.shape[:2]) - 1) * STEP
+    x, y = rng.uniform(0, width, size=n_cities), rng.uniform(0, height, size=n_cities)
+    block_x = np.minimum((x / width * cols).astype(int), cols-1)
+    block_y = np.minimum((y / height * rows).astype(int), rows-1)
+    return pd.DataFrame({
+        'ORIG_FID': np.arange(n_cities),
+        'X': x,
+        'Y': y,
+        'iso3': [COUNTRIES[by][bx] for bx, by in zip(block_x, block_y)],
+        'GDP': rng.lognormal(mean=5, sigma=1.5, size=n_cities),
+        })
+
+
+def make_inputs(folder, n_lines, n_cities, seed):
+    # Same folder layout and parameter files as the repo, so the scripts
+    #  run unchanged from inside folder
+    logger.info('1. Making synthetic network with ~{} road lines and {} cities in {}...'.format(n_lines, n_cities, folder))
+    for subfolder in ['data/geojson', 'data/csv', PARAMETER_DIR, 'output']:
+        os.makedirs(os.path.join(folder, subfolder), exist_ok=True)
+    for filename in os.listdir(PARAMETER_DIR):
+        if filename.endswith('.csv'):
+            shutil.copy(os.path.join(PARAMETER_DIR, filename), os.path.join(folder, PARAMETER_DIR, filename))
+    bcost = pd.read_csv(os.path.join(PARAMETER_DIR, 'border_costs.csv'))
+    columns = [column for column in bcost.columns if column.startswith('border_')]
+    bcost[columns] *= FEE_FACTOR
+    bcost.to_csv(os.path.join(folder, PARAMETER_DIR, 'border_costs_fees.csv'), index=False)
+
+    rng = np.random.default_rng(seed)
+    xy, roads = make_roads(n_lines, rng)
+    fragment, (x, y) = make_fragment()
+    write_features(os.path.join(folder, 'data/geojson/roads.geojson'), itertools.chain(roads, fragment))
+    sea, ports = make_sea(xy)
+    write_features(os.path.join(folder, 'data/geojson/sea_links.geojson'), sea)
+    write_features(os.path.join(folder, 'data/geojson/ports.geojson'), ports)
+    cities = make_cities(n_cities, xy, rng)
+    cities.loc[len(cities)] = {'ORIG_FID': len(cities), 'X': x, 'Y': y, 'iso3': 'CIV', 'GDP': cities['GDP'].median()}
+    cities.to_csv(os.path.join(folder, 'data/csv/cities.csv'), index=False)
+    logger.info('Synthetic network made.')
+#---------------------------------------------------
+
+
+# 2. Time the scripts
+#---------------------------------------------------
+def run_script(script, argv, folder, outfile):
+    # Runs a script from folder as a fresh process. Each numbered step it
+    #  logs starts a stage, which lasts until the next one or the end of
+    #  the run. Peak memory is the largest resident set of the whole run.
+    #  The run report the script writes next to outfile is added too.
+    command = [sys.executable, '-u', os.path.join(CODE_DIR, script)] + argv
+    logger.info('Running {}'.format(' '.join(['python', 'code/' + script] + argv)))
+    t_0 = time.perf_counter()
+    stages = [('0. Starting', t_0)]
+    result = {'script': script, 'argv': argv}
+
+    process = subprocess.Popen(command, cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    log = []
+    for line in process.stderr:
+        line = line.rstrip('\n')
+        log.append(line)
+        stage = STAGE_PATTERN.match(line)
+        if stage:
+            stages.append((stage.group(1), time.perf_counter()))
+        size = SIZE_PATTERN.search(line)
+        if size:
+            result['nodes'], result['edges'] = int(size.group(1)), int(size.group(2))
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    t_end = time.perf_counter()
+
+    result['exit_code'] = process.returncode
+    result['seconds'] = t_end - t_0
+    result['cpu_seconds'] = usage.ru_utime + usage.ru_stime
+    result['peak_rss_mb'] = usage.ru_maxrss / 1024 # ru_maxrss is in KB on Linux
+    result['stages'] = [{'stage': name, 'seconds': end - start}
+        for (name, start), (_, end) in zip(stages, stages[1:] + [(None, t_end)])]
+    if process.returncode != 0:
+        logger.warning('{} failed:\n{}'.format(script, '\n'.join(log[-20:])))
+    elif os.path.exists(os.path.join(folder, report_file(outfile))):
+        with open(os.path.join(folder, report_file(outfile))) as f:
+            result['report'] = json.load(f)
+    return result
+
+
+def compare_matrices(first, matrix, rtol=1e-9):
+    # Whether two engines give the same matrix: the same pairs reachable,
+    #  and costs equal up to rounding in the last digits
+    same_reach = bool(np.array_equal(np.isinf(first), np.isinf(matrix)))
+    reached = np.isfinite(first) & np.isfinite(matrix)
+    difference = float(np.max(np.abs(matrix[reached] - first[reached]) / np.maximum(first[reached], 1e-300), initial=0))
+    return {'same_reach': same_reach, 'max_difference': difference, 'matches': same_reach and difference <= rtol}
+
+
+def check_matrix(run, folder, matrix_file, engine, first):
+    # Compares the matrix of run with the one of the first engine in
+    #  first[matrix_file], or keeps it there if this is the first engine
+    matrix = read_matrix(os.path.join(folder, matrix_file)).to_numpy(dtype=np.float64, copy=True)
+    if matrix_file not in first:
+        first[matrix_file] = (engine, matrix)
+        return
+    run['check'] = dict(compare_matrices(first[matrix_file][1], matrix), engine=first[matrix_file][0])
+    if not run['check']['matches']:
+        logger.warning('{} engine does not match {} engine on {}: same pairs reachable {}, largest relative difference {:.3g}.'.format(
+            engine, first[matrix_file][0], matrix_file, run['check']['same_reach'], run['check']['max_difference']))
+
+
+def run_scale(folder, n_lines, n_cities):
+    # Cost matrix and MA for every engine. Cities are matched again and the
+    #  network is not cached, so every run times the full setup. Each
+    #  matrix is checked against the one of the first engine, and so is a
+    #  second matrix with FEE_FACTOR times the border costs, made by a -s
+    #  sweep on the network built with the shipped ones.
+    matrix_file = 'data/csv/cost_matrix.{}'.format(args.matrix_format)
+    fees_file = 'data/csv/cost_matrix_fees.{}'.format(args.matrix_format)
+    scenario_file = os.path.join(folder, 'data/csv/fee_scenario.csv')
+    pd.DataFrame({'outfile': [fees_file], 'bcost_file': [os.path.join(PARAMETER_DIR, 'border_costs_fees.csv')],
+        'tariff_file': ['']}).to_csv(scenario_file, index=False)
+    ma_file = 'output/market_access.csv'
+    results = []
+    first = {}
+    for engine in args.engines:
+        logger.info('2. Timing {} engine on {} road lines and {} cities...'.format(engine, n_lines, n_cities))
+        argv = ['-e', engine, '-w', str(args.workers), '--no_cache', '--force_rematch'] + (['--contract'] if args.contract else [])
+        cost = run_script('get_cost_matrix.py', ['-o', matrix_file] + argv, folder, matrix_file)
+        runs = [cost]
+        if cost['exit_code'] == 0:
+            check_matrix(cost, folder, matrix_file, engine, first)
+            runs.append(run_script('get_ma.py', ['-i', matrix_file, '-o', ma_file], folder, ma_file))
+            fees = run_script('get_cost_matrix.py', ['-o', fees_file, '-s', 'data/csv/fee_scenario.csv'] + argv, folder, fees_file)
+            if fees['exit_code'] == 0:
+                check_matrix(fees, folder, fees_file, engine, first)
+            runs.append(fees)
+        for run in runs:
+            run.update({'road_lines': n_lines, 'cities': n_cities, 'engine': engine, 'workers': args.workers, 'contract': args.contract})
+            logger.info('{}: {:.2f}s, peak memory {:.0f} MB'.format(run['script'], run['seconds'], run['peak_rss_mb']))
+        results += runs
+    return results
+#---------------------------------------------------
+
+
+# 3. Write results
+#---------------------------------------------------
+def machine_info():
+    # Enough to tell runs on different machines and versions apart
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=CODE_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    versions = {}
+    for name in ['numpy', 'pandas', 'scipy', 'networkx']:
+        versions[name] = __import__(name).__version__
+    return {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit or None,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'versions': versions,
+        }
+
+
+def write_results(results, outfile):
+    logger.info('3. Writing results to {}...'.format(outfile))
+    if os.path.dirname(outfile):
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    with open(outfile, 'w') as f:
+        json.dump({'machine': machine_info(), 'seed': args.seed, 'runs': results}, f, indent=2)
+
+    summary = pd.DataFrame([{'road_lines': r['road_lines'], 'cities': r['cities'], 'engine': r['engine'],
+        'script': ' '.join([r['script']] + (['-s'] if '-s' in r['argv'] else [])), 'seconds': r['seconds'], 'peak_rss_mb': r['peak_rss_mb']} for r in results])
+    logger.info('Results:\n{}'.format(summary.to_string(index=False, float_format='{:.2f}'.format)))
+#---------------------------------------------------
+
+
+outfile = os.path.abspath(args.outfile)
+workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark_')
+results = []
+try:
+    for n_lines, n_cities in SCALES:
+        folder = os.path.join(workdir, '{}_lines_{}_cities'.format(n_lines, n_cities))
+        make_inputs(folder, n_lines, n_cities, args.seed)
+        results += run_scale(folder, n_lines, n_cities)
+finally:
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+write_results(results, outfile)
+logger.info('All done.')
+if any(r['exit_code'] != 0 or not r.get('check', {}).get('matches', True) for r in results):
+    sys.exit(1)
@@ -1,18 +1,129 @@
 import argparse
+import logging
+import os
+import numpy as np
 import pandas as pd
+from matrix_io import read_table, write_table
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser() # Allows user to put no-borders in command line
-parser.add_argument('--file_a', '-a', help='First output file to compare', type=str)
-parser.add_argument('--file_b', '-b', help='Second output file to compare', type=str)
+parser.add_argument('--file_a', '-a', help='First output file to compare (the baseline)', type=str)
+parser.add_argument('--file_b', '-b', help='Output file(s) to compare with the first', type=str, nargs='+')
+parser.add_argument('--names', '-n', help='Give scenario names for the --file_b files (default: their file names)', type=str, nargs='+')
+parser.add_argument('--outfile', '-o', help='Set output location (default: output/compare_<a>_<b>.csv)', type=str)
+parser.add_argument('--format', '-f', help='Write one column per scenario (wide) or one row per city and scenario (long)', choices=['wide', 'long'], default='wide')
+parser.add_argument('--by_country', help='Also write mean differences by country', action='store_true')
 args = parser.parse_args()
 UNIQUE = 'ORIG_FID'
+PARAMETER_COLUMNS = ['theta', 'beta', 'harris'] # Also identify a row in get_ma.py sweep outputs
+
+if args.names and len(args.names) != len(args.file_b):
+    parser.error('Give one name for each --file_b file.')
+NAMES = args.names or [os.path.splitext(os.path.basename(f))[0] for f in args.file_b]
+
+
+def default_outfile():
+    # Same name as always for a single pair
+    def stem(filename):
+        return filename.split('/')[-1].split('.')[0]
+    if len(args.file_b) == 1:
+        return 'output/compare_' + stem(args.file_a) + '_' + stem(args.file_b[0]) + '.csv'
+    return 'output/compare_' + stem(args.file_a) + '_{}_scenarios.csv'.format(len(args.file_b))
+
+
+def suffixed(outfile, suffix):
+    root, ext = os.path.splitext(outfile)
+    return root + suffix + ext
+#---------------------------------------------------
+
+
+# 1. Read and align all outputs on the baseline
+#---------------------------------------------------
+def read_outputs():
+    # Baseline table, and new ln MA as a cities x scenarios array in the
+    #  order of the baseline rows
+    logger.info('1. Reading {} and {} scenario output(s)...'.format(args.file_a, len(args.file_b)))
+    base = read_table(args.file_a)
+    keys = [UNIQUE] + [column for column in PARAMETER_COLUMNS if column in base.columns]
+    base = base.set_index(keys)
+
+    new = np.empty((len(base), len(args.file_b)))
+    for k, filename in enumerate(args.file_b):
+        scenario = read_table(filename).set_index(keys)['ln MA']
+        new[:, k] = scenario.reindex(base.index).to_numpy(dtype=np.float64)
+        missing = np.isnan(new[:, k]).sum() - base['ln MA'].isna().sum()
+        if missing > 0:
+            logger.warning('{} rows of {} are not in {}.'.format(missing, args.file_a, filename))
+    return base, new
+#---------------------------------------------------
+
+
+# 2. Compare
+#---------------------------------------------------
+def wide_table(base, new, dif):
+    # Baseline columns, then new ln MA and difference for each scenario
+    table = base.copy()
+    if len(NAMES) == 1:
+        table['new ln MA'] = new[:, 0]
+        table['dif'] = dif[:, 0]
+        return table
+    columns = {}
+    for k, name in enumerate(NAMES):
+        columns['new ln MA ' + name] = new[:, k]
+        columns['dif ' + name] = dif[:, k]
+    return pd.concat([table, pd.DataFrame(columns, index=table.index)], axis=1)
+
+
+def long_table(base, new, dif):
+    # One row per city (and parameter set) and scenario
+    n, k = new.shape
+    index = base.index.to_frame(index=False)
+    table = index.iloc[np.tile(np.arange(n), k)].reset_index(drop=True)
+    table.insert(0, 'scenario', np.repeat(NAMES, n))
+    for column in ['iso3', 'GDP']:
+        if column in base.columns:
+            table[column] = np.tile(base[column].to_numpy(), k)
+    table['ln MA'] = np.tile(base['ln MA'].to_numpy(), k)
+    table['new ln MA'] = new.T.ravel()
+    table['dif'] = dif.T.ravel()
+    return table
+
+
+def summarize(table, groups):
+    # Difference statistics for each group, weighted by baseline GDP where
+    #  there is a GDP column
+    by = [table[group] for group in groups]
+    summary = table['dif'].groupby(by, sort=False).agg(['count', 'mean', 'median', 'std', 'min', 'max'])
+    improved = (table['dif'] > 0).where(table['dif'].notna())
+    summary['share improved'] = improved.groupby(by, sort=False).mean()
+    if 'GDP' in table.columns:
+        weights = table['GDP'].where(table['dif'].notna())
+        summary['GDP-weighted mean'] = (table['dif'] * weights).groupby(by, sort=False).sum() / \
+            weights.groupby(by, sort=False).sum()
+    return summary
+#---------------------------------------------------
+
 
-df1 = pd.read_csv(args.file_a).set_index(UNIQUE)
-df2 = pd.read_csv(args.file_b).set_index(UNIQUE)
+base, new = read_outputs()
+logger.info('2. Comparing...')
+dif = new - base['ln MA'].to_numpy(dtype=np.float64)[:, None]
+long = long_table(base, new, dif)
+outfile = args.outfile or default_outfile()
 
-df1['new ln MA'] = df2['ln MA']
-df1['dif'] = df1['new ln MA'] - df1['ln MA']
+logger.info('3. Exporting to {}...'.format(outfile))
+if args.format == 'long':
+    write_table(long, outfile)
+else:
+    write_table(wide_table(base, new, dif), outfile, index=True)
 
-outfile = 'output/compare_' + \
-    args.file_a.split('/')[-1].split('.')[0] + '_' + args.file_b.split('/')[-1].split('.')[0] + '.csv'
-df1.to_csv(outfile)
\ No newline at end of file
+summary = summarize(long, ['scenario'])
+write_table(summary, suffixed(outfile, '_summary'), index=True)
+logger.info('Differences in ln MA:\n{}'.format(summary.to_string(float_format='{:.4f}'.format)))
+if args.by_country:
+    if 'iso3' not in long.columns:
+        logger.warning('No iso3 column in {}, not comparing by country.'.format(args.file_a))
+    else:
+        write_table(summarize(long, ['scenario', 'iso3']), suffixed(outfile, '_by_country'), index=True)
+logger.info('All done.')
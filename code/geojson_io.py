@@ -0,0 +1,104 @@
+import json
+
+WHITESPACE = ' \t\n\r'
+decoder = json.JSONDecoder()
+
+
+# Read GeoJSON features one at a time
+#---------------------------------------------------
+class FeatureStream:
+    # A file read in chunks, with just enough of a JSON parser to walk
+    #  the top level of a FeatureCollection. Values are decoded with the
+    #  standard json decoder once they are completely in the buffer.
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # Drop what has been read and add the next chunk
+        chunk = self.f.read(self.chunk_size)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def peek(self):
+        # Next character that is not whitespace, '' at the end of the file
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ''
+            self.fill()
+
+    def skip(self, chars):
+        # Step over the next character if it is one of chars
+        char = self.peek()
+        if char and char in chars:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, char):
+        if not self.skip(char):
+            raise ValueError('Expected {!r} at {!r}'.format(char, self.buf[self.pos:self.pos+50]))
+
+    def value(self):
+        # A value counts as complete once something follows it, otherwise
+        #  a number cut off at the end of the buffer would look complete
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_features(filename, chunk_size=2**20, members=None):
+    # Yields the features of a GeoJSON FeatureCollection one at a time,
+    #  without holding the whole document in memory. The other members of
+    #  the collection (name, crs...) are put in members if it is a dict.
+    with open(filename, 'r') as f:
+        stream = FeatureStream(f, chunk_size)
+        stream.expect('{')
+        while not stream.skip('}'):
+            key = stream.value()
+            stream.expect(':')
+            if key == 'features':
+                stream.expect('[')
+                while not stream.skip(']'):
+                    yield stream.value()
+                    stream.skip(',')
+            else:
+                value = stream.value()
+                if members is not None and key != 'type':
+                    members[key] = value
+            stream.skip(',')
+#---------------------------------------------------
+
+
+# Write GeoJSON features one at a time
+#---------------------------------------------------
+def write_features(filename, features, members=None):
+    # Writes a FeatureCollection that iter_features can read back, without
+    #  holding the whole document in memory. Other members of the collection
+    #  are written after the features, so members can be the dict that
+    #  iter_features fills while features are read from another file.
+    with open(filename, 'w') as f:
+        f.write('{"type": "FeatureCollection", "features": [\n')
+        for i, feature in enumerate(features):
+            f.write((',\n' if i else '') + json.dumps(feature))
+        f.write('\n]')
+        for key, value in (members or {}).items():
+            f.write(', {}: {}'.format(json.dumps(key), json.dumps(value)))
+        f.write('}\n')
+#---------------------------------------------------
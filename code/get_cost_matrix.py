@@ -3,35 +3,71 @@
 # trub@uchicago.edu
 
 import argparse
+import hashlib
 import itertools
 import json
 import logging
+import os
 import pickle
 import random
 import string
+import sys
 import time
 import numpy as np
 import pandas as pd
-import networkx as nx
 from collections import OrderedDict
-from scipy import spatial, special
+from scipy import special
 from tqdm import tqdm, tqdm_pandas
+from geojson_io import iter_features
+from matrix_io import MatrixWriter, open_matrix, row_blocks, write_matrix
+from network import FEE_QUALITIES, Network
+from overlay_index import OverlayIndex
+from routing import RouteParts, changed_edges, compile_csr, contract_chains, csr_origin_costs, nx_origin_costs, reweight_csr, rows_to_update
+from run_report import RunReport, report_file
+from spatial_index import NodeIndex
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 tqdm.pandas() # Gives us nice progress bars
 parser = argparse.ArgumentParser() # Allows user to put no-borders in command line
-parser.add_argument('--outfile', '-o', help='Set output location', type=str, default='data/csv/cost_matrix.csv')
+parser.add_argument('--outfile', '-o', help='Set output location (.csv, .npy or .parquet)', type=str, default='data/csv/cost_matrix.csv')
+parser.add_argument('--dtype', help='Set float precision of the output matrix', choices=['float64', 'float32'], default='float64')
 parser.add_argument('--bcost_file', '-b', help='Give border cost file location', type=str, default='parameters/border_costs.csv')
 parser.add_argument('--road_file', '-r', help='Give roads file location', type=str, default='data/geojson/roads.geojson')
 parser.add_argument('--time', '-t', help='Use time instead of freight cost', action='store_true')
 parser.add_argument('--force_rematch', '-f', help='Match cities with nodes again (may affect results)', action='store_true')
 parser.add_argument('--harris', '-harris', help='Calculate costs for Harris 1954-style market potential (theta=1)', action='store_true')
+parser.add_argument('--engine', '-e', help='Routing engine for the cost matrix', choices=['networkx', 'csr', 'overlay'], default='networkx')
+parser.add_argument('--workers', '-w', help='Number of processes for the cost matrix', type=int, default=1)
+parser.add_argument('--scenario_file', '-s', help='Give CSV of border cost/tariff scenarios to run on one network (columns outfile, bcost_file, tariff_file)', type=str)
+parser.add_argument('--baseline_road_file', '-B', help='Give baseline roads file; only rows the changed roads can affect are recalculated', type=str)
+parser.add_argument('--cache_dir', '-c', help='Set location of the built network cache', type=str, default='data/cache')
+parser.add_argument('--no_cache', help='Always rebuild the network, do not read or write the cache', action='store_true')
+parser.add_argument('--contract', help='Route on a copy of the network with chains of degree-2 nodes contracted into single edges', action='store_true')
+parser.add_argument('--check_contraction', help='Compare some rows of the contracted network with the full network', action='store_true')
+parser.add_argument('--max_cost', help='Stop routing at this cost; city pairs beyond it get -1 and are left out of MA', type=float)
+parser.add_argument('--ma_tolerance', help='Set the cutoff so each city pair left out adds less than this times its GDP to MA', type=float)
+parser.add_argument('--out_of_core', help='Write each row to the .npy output as soon as it is calculated, so the matrix is never held in memory', action='store_true')
+parser.add_argument('--routes', help='Also write the cost of each city pair split into transport, border, port and tariff, and how much each edge is used (csr engine)', action='store_true')
+parser.add_argument('--no_report', help='Do not write the run report (timing and memory of each step) next to the output', action='store_true')
+parser.add_argument('--profile', help='Profile the run and add the hottest functions to the run report', action='store_true')
 args = parser.parse_args()
 
 # 0. Make cost assumptions, set file names
 #---------------------------------------------------
+if args.out_of_core:
+    # Checked for every scenario before any is run
+    outfiles = pd.read_csv(args.scenario_file)['outfile'].tolist() if args.scenario_file else [args.outfile]
+    not_npy = [outfile for outfile in outfiles if not str(outfile).lower().endswith('.npy')]
+    if not_npy:
+        parser.error('--out_of_core needs .npy outfiles, not {}.'.format(', '.join(map(str, not_npy))))
+if args.out_of_core and (args.engine == 'overlay' or args.baseline_road_file):
+    parser.error('--out_of_core does not work with the overlay engine or -B, which hold all city pairs in memory.')
+if args.routes and (args.engine != 'csr' or args.contract or args.baseline_road_file):
+    parser.error('--routes needs --engine csr, and does not work with --contract or -B.')
+REPORT = None if args.no_report else RunReport('get_cost_matrix.py', sys.argv[1:], report_file(args.outfile), profile=args.profile)
+
 TCOST = pd.read_csv('parameters/transport_costs.csv').set_index('class').to_dict()['cost_per_km']
 if args.time:
     TCOST = pd.read_csv('parameters/transport_speeds.csv').set_index('class')
@@ -40,6 +76,7 @@ if args.time:
 BCOST = pd.read_csv(args.bcost_file).set_index('iso3')
 TARIFF = pd.read_csv('parameters/tariffs.csv').set_index('iso3')
 PARAMS = pd.read_csv('parameters/other_cost_parameters.csv').set_index('parameter').to_dict()['value']
+MA_PARAMS = pd.read_csv('parameters/market_access_parameters.csv').set_index('parameter').to_dict()['value']
 
 CITIES_CSV = 'data/csv/cities.csv'
 ROAD_FILE = args.road_file
@@ -49,64 +86,80 @@ PORTS_FILE = 'data/geojson/ports.geojson'
 # BCROSS_FILE = args.bcross_file
 # EXTERNAL_TSV = None
 
+# The cached network depends on these files. Bump the version whenever
+#  setup() changes the way the network is built.
+CACHE_VERSION = 3
+OVERLAY_VERSION = 2 # Bump whenever the overlay index is built differently
+COST_FILES = ['parameters/transport_costs.csv', 'parameters/transport_speeds.csv',
+    'parameters/other_cost_parameters.csv', args.bcost_file]
+
 logger.info('Cost matrix will export to {}.'.format(args.outfile))
 logger.info('Running {}...'.format('TIME model' if args.time else 'FREIGHT COST MODEL'))
+logger.info('Routing with {} engine on {} worker(s).'.format(args.engine, args.workers))
 if args.harris:
     logger.info('Preparing costs for market potential (Harris 1954)...')
     PARAMS['shipment_time_value'] = 1
+    MA_PARAMS['theta'] = 1
+SHIPMENT_VALUE = PARAMS['shipment_time_value'] if args.time else PARAMS['shipment_usd_value']
+
+# Optional cutoff. An MA term is GDP * (c+1)^-theta (GDP / c for Harris),
+#  so with --ma_tolerance the cutoff is the cost where that factor falls
+#  to the tolerance. The cutoff applies to the matrix value, tariffs
+#  included. Tariffs are only ever added, so routing can stop at the
+#  cutoff times the shipment value.
+MAX_COST = args.max_cost
+if args.ma_tolerance is not None:
+    if args.harris:
+        tolerance_cost = 1 / args.ma_tolerance
+    else:
+        tolerance_cost = args.ma_tolerance**(-1/MA_PARAMS['theta']) - 1
+    MAX_COST = tolerance_cost if MAX_COST is None else min(MAX_COST, tolerance_cost)
+ROUTE_LIMIT = np.inf if MAX_COST is None else MAX_COST * SHIPMENT_VALUE
+if MAX_COST is not None:
+    logger.info('City pairs costing more than {:.6g} will be set to -1.'.format(MAX_COST))
 #---------------------------------------------------
 
 
 # 1. Read GeoJSONs
 #---------------------------------------------------
-def read_geojsons():
-
-    def features_to_graph(features, iso):
-        # Directed graph is necessary because borders have
-        # asymmetric costs
-        G = nx.DiGraph() 
+def read_geojsons(road_file=ROAD_FILE):
+
+    def features_to_edges(features, iso=None):
+        # Directed network is necessary because borders have
+        # asymmetric costs. Each line gives an edge in both
+        # directions between its end points. Nodes are (x, y, iso),
+        # with iso the line's own country unless one is given.
+        # Only the properties that are used are kept.
+        tails, heads, length, quality, iso3 = [], [], [], [], []
         for line in features:
-            start = tuple(line['geometry']['coordinates'][0][0]+[iso])
-            end = tuple(line['geometry']['coordinates'][0][-1]+[iso])
-
-            # Add edge in both directions
-            k = G.add_edge(start, end)
-            k = G.add_edge(end, start)
-            for prop in line['properties']:
-                G[start][end][prop] = line['properties'][prop]
-                G[end][start][prop] = line['properties'][prop]
-        return G
+            props = line['properties']
+            node_iso = props['iso3'] if iso is None else iso
+            start = tuple(line['geometry']['coordinates'][0][0]+[node_iso])
+            end = tuple(line['geometry']['coordinates'][0][-1]+[node_iso])
+            tails += [start, end]
+            heads += [end, start]
+            length += [props['length']]*2
+            quality += [props['quality']]*2
+            iso3 += [props.get('iso3')]*2
+        return tails, heads, length, quality, iso3
 
     logger.info('1. Reading GeoJSONs...')
 
-    # Roads need to be read in one country at a time.
-    #  Create a separate graph for each country. Then
-    #  connect the graphs at designated border points.
-    with open(ROAD_FILE, 'r') as f:
-        road_json = json.load(f)
-
-    ## Get all the countries
-    countries = set()
-    for feature in road_json['features']:
-        countries.add(feature['properties']['iso3'])
-
-    ## Create & compose the graphs one at a time
-    road = nx.DiGraph()
-    for iso in countries:
-        road_features_i = [feature for feature in road_json['features'] if feature['properties']['iso3']==iso]
-        G_i = features_to_graph(road_features_i, iso)
-        road = nx.compose(road, G_i)
+    # Roads are read one feature at a time, in a single pass, straight
+    #  into the network. Nodes of different countries never coincide since
+    #  their iso differs, so the network falls apart into one part per
+    #  country. The parts are connected at border points in step 6.
+    #  road, rail and sea are the node IDs of each layer.
+    G = Network()
+    G.add_edges(*features_to_edges(iter_features(road_file)))
+    road = np.arange(G.number_of_nodes())
     
     ## Sea is separate. Rail is not implemented.
     # rail = geojson_to_graph(RAIL_FILE, z=1000)
-    rail = nx.DiGraph() # Empty
+    rail = np.empty(0, dtype=np.int64) # Empty
 
-    with open(SEA_FILE, 'r') as f:
-        sea_json = json.load(f)
-    sea = features_to_graph(sea_json['features'], 'sea')
-
-    G = nx.compose(road, rail)
-    G = nx.compose(G, sea)
+    G.add_edges(*features_to_edges(iter_features(SEA_FILE), 'sea'))
+    sea = np.arange(len(road), G.number_of_nodes())
     logger.info('GeoJSONs read.')
     return road, rail, sea, G
 #---------------------------------------------------
@@ -114,101 +167,94 @@ def read_geojsons():
 
 # 2. Find nearest nodes to cities
 #---------------------------------------------------
-def get_highest_quality_node_within_radius(point, iso3, nodelist, g, r=0.05):
-    nodes_just_xy = np.array([(node[0], node[1]) for node in nodelist], dtype=np.float64) # Ignore country
-    kdtree_query_result_node_ids = spatial.KDTree(nodes_just_xy).query(point, k=500, distance_upper_bound=r)[1] # Use scipy magic to quickly get nearest nodes. Get 0.1 degrees = ~10 km
-    all_within_r_ids = list(OrderedDict.fromkeys(kdtree_query_result_node_ids)) # Remove duplicates preserving order
-    all_within_r_ids = [a for a in all_within_r_ids if a != len(nodelist)] # Since the result is padded with placeholder value if fewer than k are found
-    all_within_r = [tuple(nodelist[i]) for i in all_within_r_ids] # Get actual nodes
-    
-    # Make sure nodes are within the city's country
-    all_within_r = [node for node in all_within_r if node[2]==iso3]
-
-    # If there are no nodes within radius, just take the closest node
-    if not all_within_r:
-        idx = spatial.KDTree(nodes_just_xy).query(point)[1]
-        return tuple(nodelist[idx])
-
-    # Find highest quality level within radius
-    def max_quality(node):
-        best_q_dest = sorted(g[node], key=lambda x: g[node][x]['quality'])[-1]
-        return g[node][best_q_dest]['quality']
-
-    best_quality = 0
-    for candidate in all_within_r:
-        candidate_max_quality = max_quality(candidate)
-        if candidate_max_quality > best_quality:
-            best_quality = candidate_max_quality
-
-    # Find closest node of that quality
-    return next(node for node in all_within_r if max_quality(node)==best_quality)
-
-
-def match_cities_with_nodes(road, rail, sea, G):
+def match_cities_with_nodes(road, rail, sea, G, road_index, sea_index):
     cities = pd.read_csv(CITIES_CSV, converters={'nearest_road': eval, 'nearest_rail': eval, 'nearest_sea': eval, 'nearest_any': eval})
-    road_nodes = list(road.nodes)
-    rail_nodes = list(rail.nodes)
-    sea_nodes = list(sea.nodes)
-    any_nodes = list(G.nodes)
 
     logger.info('2. Matching cities with nodes...')
     if ('nearest_road' not in cities.columns) or (args.force_rematch):
-        def get_nearest_node(row):
-            point = list(row[['X', 'Y']]) # X, Y coordinates of city in projection
-            iso3 = row['iso3']
-            row['nearest_road'] = get_highest_quality_node_within_radius(point, iso3, road_nodes, road)
-            # row['nearest_rail'] = get_highest_quality_node_within_radius(point, rail_nodes, rail)
-            row['nearest_sea'] = tuple(sea_nodes[spatial.KDTree(np.array([(n[0], n[1]) for n in sea_nodes], dtype=np.float64)).query(point)[1]])
-            # row['nearest_any'] = sorted([row['nearest_road'], row['nearest_sea']],
-            #     key=lambda x: np.linalg.norm(np.array(point) - np.array(x[:2]))\
-            #     )[0]
-            row['nearest_any'] = row['nearest_road']
-            return row
-        cities = cities.progress_apply(get_nearest_node, axis=1)
+        points = cities[['X', 'Y']].to_numpy(dtype=np.float64) # X, Y coordinates of cities in projection
+        cities['nearest_road'] = road_index.highest_quality_within(points, cities['iso3'])
+        # cities['nearest_rail'] = rail_index.highest_quality_within(points, cities['iso3'])
+        cities['nearest_sea'] = sea_index.nearest(points)
+        # cities['nearest_any'] = [sorted([road_node, sea_node],
+        #     key=lambda x: np.linalg.norm(point - np.array(x[:2]))\
+        #     )[0] for point, road_node, sea_node in zip(points, cities['nearest_road'], cities['nearest_sea'])]
+        cities['nearest_any'] = cities['nearest_road']
         cities.to_csv(CITIES_CSV, index=False)
     logger.info('\nCities matched.')
         
-    return cities, road_nodes, rail_nodes, sea_nodes, any_nodes
+    return cities
 #---------------------------------------------------
 
 
 # 3. Add cost attributes to graph
 #---------------------------------------------------
+def transport_costs(quality, length):
+    # careful: costs are per km, length is in meters. Looked up once per
+    #  quality, not once per edge.
+    qualities, inverse = np.unique(quality.astype(str), return_inverse=True)
+    cost_per_km = np.array([TCOST[q] for q in qualities], dtype=np.float64)
+    return cost_per_km[inverse] * length/1000
+
+
 def add_costs_to_graph(G):
     logger.info('3. Adding costs to graph...')
-    for u, v in G.edges:
-        if 'cost' not in G[u][v]: # careful: costs are per km, length is in meters
-            G[u][v]['cost'] = TCOST[str(G[u][v]['quality'])] * G[u][v]['length']/1000
-            G[v][u]['cost'] = TCOST[str(G[v][u]['quality'])] * G[v][u]['length']/1000
+    todo = np.isnan(G.cost)
+    G.cost[todo] = transport_costs(G.quality[todo], G.length[todo])
     logger.info('Costs added.')
     return G
+
+
+def border_cost(country):
+    # Cost to leave a country over a land border. We do not add import
+    #  costs because that would be double counting
+    if args.time:
+        return BCOST.loc[country]['border_time_export']
+    return BCOST.loc[country]['border_fee_export']
+
+
+def port_cost(country):
+    port_fee = PARAMS['port_wait_time'] if args.time else PARAMS['port_fee']
+    return port_fee + BCOST.loc[country]['border_fee_export']
+
+
+def fee_costs(iso3, fee):
+    # fee(country) for each country, looked up once per country
+    countries = {country: fee(country) for country in set(iso3)}
+    return np.array([countries[country] for country in iso3], dtype=np.float64)
+
+
+def reweight_graph(G, fees_only=False):
+    # Recompute costs in an already built network, e.g. one read from the
+    #  cache, after the cost parameters have changed. With fees_only, only
+    #  border crossings and port transfers are updated.
+    logger.info('3. Updating costs on {}...'.format('fee edges' if fees_only else 'graph'))
+    border = G.quality == 'border_crossing'
+    port = G.quality == 'port_fee'
+    if not fees_only:
+        other = ~(border | port)
+        G.cost[other] = transport_costs(G.quality[other], G.length[other])
+    G.cost[border] = fee_costs(G.iso3[border], border_cost)
+    G.cost[port] = fee_costs(G.iso3[port], port_cost)
+    logger.info('Costs updated.')
+    return G
 #---------------------------------------------------
 
 
 # 4. Find nearest nodes to ports
 #---------------------------------------------------
-def find_nearest_nodes_to_ports(road, rail, sea, G):
-    with open(PORTS_FILE, 'r') as p:
-        ports_geojson = json.load(p)
-    ports_nodes = [tuple(f['geometry']['coordinates']) for f in ports_geojson['features']]
+def find_nearest_nodes_to_ports(road, rail, sea, G, road_index, sea_index):
+    ports_nodes = [tuple(f['geometry']['coordinates']) for f in iter_features(PORTS_FILE)]
     ports = pd.DataFrame(ports_nodes, columns=['X', 'Y'])
-    road_nodes = list(road.nodes)
-    rail_nodes = list(rail.nodes)
-    sea_nodes = list(sea.nodes)
-    any_nodes = list(G.nodes)
     
     logger.info('4. Matching ports with nodes...')
-    def get_nearest_node(row):
-        point = list(row[['X', 'Y']]) # X, Y coordinates of city in projection
-        row['nearest_road'] = get_highest_quality_node_within_radius(point, 'sea', road_nodes, road)
-        # row['nearest_rail'] = get_highest_quality_node_within_radius(point, rail_nodes, rail)
-        row['nearest_sea'] = tuple(sea_nodes[spatial.KDTree(np.array([(n[0], n[1]) for n in sea_nodes], dtype=np.float64)).query(point)[1]])
-        row['nearest_any'] = sorted([row['nearest_road'], row['nearest_sea']],
-            key=lambda x: np.linalg.norm(np.array(point) - np.array(x[:2]))\
-            )[0]
-        return row
-
-    ports = ports.progress_apply(get_nearest_node, axis=1)
+    points = ports[['X', 'Y']].to_numpy(dtype=np.float64) # X, Y coordinates of ports in projection
+    ports['nearest_road'] = road_index.highest_quality_within(points, ['sea']*len(ports))
+    # ports['nearest_rail'] = rail_index.highest_quality_within(points, ['sea']*len(ports))
+    ports['nearest_sea'] = sea_index.nearest(points)
+    ports['nearest_any'] = [sorted([road_node, sea_node],
+        key=lambda x: np.linalg.norm(point - np.array(x[:2]))\
+        )[0] for point, road_node, sea_node in zip(points, ports['nearest_road'], ports['nearest_sea'])]
     logger.info('\nCities matched.')
     return ports
 #---------------------------------------------------
@@ -236,23 +282,20 @@ def find_nearest_nodes_to_ports(road, rail, sea, G):
 #---------------------------------------------------
 def create_sea_transfers(ports, G):
     logger.info('5. Creating sea transfers...')
-    port_cost = PARAMS['port_wait_time'] if args.time else PARAMS['port_fee']
+    first_iso3 = G.first_out_iso3()
+    tails, heads, countries = [], [], []
     for i in range(len(ports)):
         x, y, u, v = list(ports.iloc[i][['X', 'Y', 'nearest_road', 'nearest_sea']])
         port_is_near_road = np.sqrt((x-u[0])**2 + (y-u[1])**2) < 0.05
         port_is_near_sea_link = np.sqrt((x-v[0])**2 + (y-v[1])**2) < 0.05
 
-        country = G[u][list(G[u])[0]]['iso3']
-        cost_ab = BCOST.loc[country]['border_fee_export']
+        country = first_iso3[G.node_ids([u])[0]]
         if port_is_near_road and port_is_near_sea_link:
-            G.add_edge(u, v,
-                length=0,
-                quality='port_fee',
-                cost=port_cost+cost_ab)
-            G.add_edge(v, u,
-                length=0,
-                quality='port_fee',
-                cost=port_cost+cost_ab)
+            tails += [u, v]
+            heads += [v, u]
+            countries += [country, country]
+    G.add_edges(tails, heads, length=0, quality='port_fee', iso3=countries,
+        cost=fee_costs(countries, port_cost))
     logger.info('Sea transfers created.')
     return G
 #---------------------------------------------------
@@ -260,60 +303,200 @@ def create_sea_transfers(ports, G):
 
 # 6. Create border crossings
 #---------------------------------------------------
-def create_border_crossings(road_nodes, G):
+def find_border_crossings(G, ids):
+    # Nodes of different countries at exactly the same X, Y. The nodes in
+    #  ids are grouped on a hash of their coordinates, and every pair of
+    #  nodes at the same point is a crossing, in both directions, so 3 or
+    #  more countries can meet at one point. Returns the tails and heads.
+    xy = pd.DataFrame({'x': G.x[ids], 'y': G.y[ids]})
+    point = xy.groupby(['x', 'y'], sort=False).ngroup().to_numpy()
+    shared = point >= 0 # NaN coordinates are not grouped
+    shared[shared] = np.bincount(point[shared])[point[shared]] > 1
+    nodes, point = ids[shared], point[shared]
+    order = np.argsort(point, kind='stable') # Nodes at each point together, in the order they were added
+    nodes, point = nodes[order], point[order]
+
+    # Pair every node with every node at its point (itself included, which is dropped)
+    starts = np.flatnonzero(np.r_[True, point[1:] != point[:-1]])
+    sizes = np.diff(np.r_[starts, len(nodes)])
+    n_pairs = np.repeat(sizes, sizes)
+    tails = np.repeat(nodes, n_pairs)
+    offset = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    heads = nodes[np.repeat(np.repeat(starts, sizes), n_pairs) + offset]
+    crossing = tails != heads
+    logger.info('Found {} border crossings at {} points ({} where 3 or more countries meet).'.format(
+        crossing.sum(), len(starts), (sizes > 2).sum()))
+    record(border_crossings=int(crossing.sum()), border_points=len(starts), border_junctions=int((sizes > 2).sum()))
+    return tails[crossing], heads[crossing]
+
+
+def create_border_crossings(road, G):
     logger.info('6. Creating border crossings...')
-
-    def find_border_crossings(g):
-        # Find crossings by sorting the nodes, then checking for repeat coordinates.
-        # A crossing will have the same X, Y but different country
-        sorted_nodes = sorted(list(g.nodes()), key=lambda tup: tup[0])
-        crossings = []
-        for prev_node, cur_node in zip(sorted_nodes, sorted_nodes[1:]+[sorted_nodes[0]]):
-            if (cur_node[0], cur_node[1]) == (prev_node[0], prev_node[1]):
-                crossings.append([prev_node, cur_node])
-        return crossings
-
-    crossings = find_border_crossings(G)
-
-    for node_a, node_b in crossings:
-        country_a = G[node_a][list(G[node_a])[0]]['iso3']
-        country_b = G[node_b][list(G[node_b])[0]]['iso3']
-
-        if args.time:
-            cost_ab = BCOST.loc[country_a]['border_time_export'] # We do not add import costs because that would be double counting
-            cost_ba = BCOST.loc[country_b]['border_time_export']
-        else:
-            cost_ab = BCOST.loc[country_a]['border_fee_export']
-            cost_ba = BCOST.loc[country_b]['border_fee_export']
-            
-        if min([cost_ab, cost_ba]) < 0:
-            logger.warning('Border cost is less than zero!')
-
-        G.add_edge(node_a, node_b,
-            length=0,
-            quality='border_crossing',
-            cost=cost_ab)
-        G.add_edge(node_b, node_a,
-            length=0,
-            quality='border_crossing',
-            cost=cost_ba)
+    tails, heads = find_border_crossings(G, road)
+
+    # Nodes are (x, y, iso), so the node's own iso is its country
+    countries = G.iso[tails]
+    costs = fee_costs(countries, border_cost)
+    if len(costs) and costs.min() < 0:
+        logger.warning('Border cost is less than zero!')
+
+    G.add_edges_by_id(tails, heads,
+        length=0,
+        quality='border_crossing',
+        iso3=countries,
+        cost=costs)
     logger.info('Border crossings created.')
     return G
 #---------------------------------------------------
 
 
+# 6b. Contract chains of degree-2 nodes
+#---------------------------------------------------
+def contract_graph(G, cities):
+    # Long roads are chains of nodes that each link just two others.
+    #  Routing only needs their ends, so the chains become single edges.
+    #  City nodes and both ends of border crossings and port transfers
+    #  are always kept, so fees can still be updated on the copy.
+    logger.info('6b. Contracting chains of degree-2 nodes...')
+    fees = fee_edges(G)
+    fee_nodes = {node for edge in fees for node in edge}
+    H = contract_chains(G.to_networkx(), set(cities['nearest_any']) | fee_nodes, weight='cost')
+    # The copy only keeps the cost, so mark the fee edges again. Otherwise
+    #  the overlay index would take their current cost as fixed.
+    for (u, v), quality in zip(fees, G.quality[G.is_fee()]):
+        H[u][v]['quality'] = quality
+    record(contracted_nodes=H.number_of_nodes(), contracted_edges=H.number_of_edges())
+    logger.info('Contracted network has {} of {} nodes ({:.1%}) and {} of {} edges ({:.1%}).'.format(
+        H.number_of_nodes(), G.number_of_nodes(), H.number_of_nodes()/G.number_of_nodes(),
+        H.number_of_edges(), G.number_of_edges(), H.number_of_edges()/G.number_of_edges()))
+    if args.check_contraction:
+        check_contraction(G, H, cities)
+    return H
+
+
+def check_contraction(G, H, cities, n_origins=10, rtol=1e-9):
+    # Routes a few cities on both networks and compares the costs
+    origin_nodes, target_nodes = city_nodes(cities)
+    sample = target_nodes[::max(1, len(target_nodes)//n_origins)][:n_origins]
+    full, contracted = [np.array([target_costs(costs, target_nodes) for costs in route(g, sample, target_nodes)])
+        for g in (G, H)]
+    same_reach = np.array_equal(np.isinf(full), np.isinf(contracted))
+    reached = np.isfinite(full)
+    difference = np.max(np.abs(contracted - full)[reached] / np.maximum(full[reached], 1e-300), initial=0)
+    logger.info('Checked {} origins against the full network: largest relative difference {:.3g}.'.format(len(sample), difference))
+    if not same_reach or difference > rtol:
+        logger.warning('Contracted network does not match the full network!')
+#---------------------------------------------------
+
+
 # 7. Run cost matrix calculation
 #---------------------------------------------------
-def get_cost_matrix(cities, G):
+def city_nodes(cities):
+    # Network node of every city, in city order, and the same without repeats
+    origin_nodes = cities['nearest_any'].tolist()
+    target_nodes = list(OrderedDict.fromkeys(origin_nodes))
+    return origin_nodes, target_nodes
+
+
+def route(G, origin_nodes, target_nodes, compiled=None, limit=np.inf, settled=None, routes=None):
+    # Yields a {node: cost} dict (or an array in the order of target_nodes)
+    #  for each origin, in order. Only costs are needed, not paths. Targets
+    #  beyond limit may be missing or np.inf. G is the Network or its
+    #  contracted networkx copy. compiled is a CSR graph or an overlay
+    #  index made from G beforehand. The nodes settled per origin are
+    #  added to settled, if given (not for the overlay engine). routes is a
+    #  RouteParts to fill (csr engine only).
+    if args.engine == 'overlay':
+        index = compiled if compiled is not None else OverlayIndex.build(fixed_csr(G), target_nodes, fee_edges(G))
+        return index.origin_costs(current_fees(G, index.fee_edges), origin_nodes, target_nodes)
+    if args.engine == 'csr':
+        nodes, node_index, csr = compiled if compiled is not None else to_csr(G)
+        return csr_origin_costs(csr, node_index, origin_nodes, target_nodes, workers=args.workers, limit=limit, settled=settled, routes=routes)
+    if isinstance(G, Network):
+        G = G.to_networkx()
+    return nx_origin_costs(G, origin_nodes, target_nodes, workers=args.workers, limit=limit, settled=settled)
+
+
+def settled_counts():
+    # Where routing for the matrix records its settled nodes
+    return None if REPORT is None else REPORT.settled
+
+
+def record(**counts):
+    if REPORT is not None:
+        REPORT.record(**counts)
+
+
+def to_csr(G):
+    # Network and networkx graphs give the same CSR graph
+    return G.to_csr() if isinstance(G, Network) else compile_csr(G, weight='cost')
+
+
+def fixed_csr(G):
+    # CSR graph without the fee edges, for the overlay index
+    if isinstance(G, Network):
+        return G.to_csr(keep=~G.is_fee())
+    fixed = G.copy()
+    fixed.remove_edges_from(fee_edges(G))
+    return compile_csr(fixed, weight='cost')
+
+
+def fee_edges(G):
+    # Edges whose cost depends on the border cost file
+    if isinstance(G, Network):
+        return G.fee_edges()
+    return [(u, v) for u, v, quality in G.edges(data='quality') if quality in FEE_QUALITIES]
+
+
+def current_fees(G, edges):
+    # Current cost of each fee edge in edges
+    if isinstance(G, Network):
+        return G.fee_costs(edges)
+    return np.array([G[u][v]['cost'] for u, v in edges], dtype=np.float64)
+
+
+def target_costs(costs, target_nodes):
+    # Costs to target_nodes as an array, from a {node: cost} dict or from
+    #  an array that is already in that order
+    if isinstance(costs, np.ndarray):
+        return costs
+    return np.array([costs.get(node, np.inf) for node in target_nodes], dtype=np.float64)
+
+
+def get_cost_matrix(cities, G, compiled=None, origin_costs=None, outfile=None, routes=None, routes_file=None):
+    # Returns the matrix as a DataFrame, or with outfile, writes each row
+    #  straight into that .npy file as it is calculated and returns None.
+    #  With routes_file (the name of the cost matrix), the parts of each
+    #  cost and the use of each edge are written next to it, from routes
+    #  if origin_costs fills one.
     all_cities = cities['ORIG_FID'].tolist() # Field just needs to be a unique ID
-    country_of = cities.set_index('nearest_any').to_dict()['iso3']
-    nearest_node = cities.set_index('ORIG_FID').to_dict()['nearest_any']
-    matrix_dict = dict()
+    origin_nodes, target_nodes = city_nodes(cities)
+    if outfile is None:
+        matrix = np.zeros((len(all_cities), len(all_cities)))
+    else:
+        writer = MatrixWriter(outfile, all_cities, dtype=args.dtype)
+    if routes_file is not None:
+        part_matrices = {part: MatrixWriter(part_file(routes_file, part), all_cities, dtype=args.dtype) if outfile is not None
+            else np.zeros((len(all_cities), len(all_cities))) for part in ROUTE_PARTS + ['tariff']}
+
+    # Everything per destination city is looked up once, so each row is
+    #  just a gather and a few array operations
+    target_of = pd.Index(target_nodes).get_indexer(origin_nodes) # Column of each city in the target costs
+    country_of = dict(zip(cities['nearest_any'], cities['iso3']))
+    country = np.array([country_of[node] for node in origin_nodes], dtype=object)
+    if args.time:
+        tariff = np.zeros(len(all_cities)) # No tariffs if using time
+    else:
+        tariff = TARIFF.loc[country, 'tariff'].to_numpy(dtype=float) # Tariffs at destination [ad valorem]
+
+    if origin_costs is None:
+        routes = route_parts(G, cities) if routes_file is not None else None
+        origin_costs = route(G, origin_nodes, target_nodes, compiled=compiled, limit=ROUTE_LIMIT, settled=settled_counts(), routes=routes)
 
     counter = 0
     n_iter = len(all_cities)
     t_0 = time.time()
-    for city_a in all_cities:
+    for i, costs in enumerate(origin_costs):
         counter += 1
         print('{:.2f}% done.   Elapsed: {:.1f}m    Time remain: {:.1f}m    Avg {:.2f} s/iter...'.format(
             100*counter/n_iter, 
@@ -322,56 +505,272 @@ def get_cost_matrix(cities, G):
             (time.time()- t_0)/counter),
             end='\r')
 
-        city_a_node = nearest_node[city_a]
-        costs, paths = nx.single_source_dijkstra(G, city_a_node, weight='cost')
-        costs_cities = []
+        raw_cost = target_costs(costs, target_nodes)[target_of]
+        transport_cost = raw_cost / SHIPMENT_VALUE # (Raw transport cost + border costs) / shipment value [ad valorem]
+        row = np.where(country != country[i], transport_cost + tariff, transport_cost)
+        if MAX_COST is not None:
+            row[raw_cost > ROUTE_LIMIT] = -1 # Beyond the cutoff, a dummy value MA skips
+            row[row > MAX_COST] = -1 # Also pairs that only get there with the tariff
+        row[i] = 0.0
+        if outfile is None:
+            matrix[i] = row
+        else:
+            writer.write(row)
+        if routes_file is not None:
+            parts = np.column_stack([routes.rows.popleft()[target_of] / SHIPMENT_VALUE, np.where(country != country[i], tariff, 0)])
+            parts[~np.isfinite(row) | (row < 0)] = np.nan # Unreachable or beyond the cutoff
+            parts[i] = 0.0
+            for k, part in enumerate(ROUTE_PARTS + ['tariff']):
+                if outfile is None:
+                    part_matrices[part][i] = parts[:, k]
+                else:
+                    part_matrices[part].write(parts[:, k])
+
+    print('\r100% done.   Elapsed: {:.1f}m    Time remain: {:.1f}m    Avg {:.2f} s/iter...'.format(
+        (time.time()- t_0)/60,
+        (n_iter-counter)*(time.time()- t_0)/(60 * counter), 
+        (time.time()- t_0)/counter))
+
+    if outfile is not None:
+        writer.close()
+        logger.info('Exported to {}.'.format(outfile))
+        matrix = open_matrix(outfile)[1]
+    if routes_file is not None:
+        write_routes(G, cities, routes, part_matrices, routes_file)
+    if MAX_COST is not None:
+        report_cutoff_error(matrix, cities)
+    if outfile is not None:
+        return None
+    return pd.DataFrame(matrix, index=all_cities, columns=all_cities)
+
+
+def report_cutoff_error(matrix, cities):
+    # Each pair left out would have added less than GDP * (MAX_COST+1)^-theta
+    #  to FMA or CMA, so ln FMA is at most ln(1 + left out / kept) too low,
+    #  and the same for CMA. Uses the MA parameters in get_ma.py's defaults.
+    #  Goes through the matrix a block of rows at a time, so it also works
+    #  on a matrix on disk.
+    gdp = cities['GDP'].to_numpy(dtype=np.float64)
+    fma_skipped, fma_kept, cma_skipped, cma_kept = [np.zeros(len(gdp)) for k in range(4)]
+    n_skipped = 0
+    if args.harris:
+        max_factor = 1 / MAX_COST
+    else:
+        max_factor = np.float_power(MAX_COST + 1, -MA_PARAMS['theta'])
+
+    for rows in row_blocks(*matrix.shape):
+        block = np.asarray(matrix[rows], dtype=np.float64)
+        skipped = block < 0
+        n_skipped += int(skipped.sum())
+        costs = np.where(skipped, np.inf, np.maximum(block, MA_PARAMS['min_cost']))
+        costs[np.arange(len(costs)), np.arange(rows.start, rows.stop)] = np.inf # Diagonal
+        with np.errstate(divide='ignore'):
+            factor = 1 / costs if args.harris else np.float_power(costs + 1, -MA_PARAMS['theta'])
+        fma_skipped += (gdp[rows, None] * skipped).sum(axis=0) # Over origins, for each destination
+        fma_kept += (gdp[rows, None] * factor).sum(axis=0)
+        cma_skipped[rows] = (gdp[None, :] * skipped).sum(axis=1) # Over destinations, for each origin
+        cma_kept[rows] = (gdp[None, :] * factor).sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fma_error = np.log1p(fma_skipped * max_factor / fma_kept)
+        cma_error = np.log1p(cma_skipped * max_factor / cma_kept)
+    ma_error = (1-MA_PARAMS['beta'])*fma_error + MA_PARAMS['beta']*cma_error
+    logger.info('{} of {} city pairs are beyond the cutoff. ln MA is at most {:.3g} too low (median city {:.3g}).'.format(
+        n_skipped, matrix.size - len(matrix), ma_error.max(), np.median(ma_error)))
+    record(pairs_beyond_cutoff=n_skipped)
+#---------------------------------------------------
 
-        for city_b in all_cities:
-            if city_a == city_b:
-                costs_cities.append(0.0)
-                continue
 
-            city_b_node = nearest_node[city_b]
-            
-            if args.time:
-                transport_cost = costs[city_b_node] / PARAMS['shipment_time_value']
-                tariff = 0 # No tariffs if using time
-            else:
-                transport_cost = costs[city_b_node] / PARAMS['shipment_usd_value'] # (Raw transport cost + border costs) / shipment value [ad valorem]
-                tariff = TARIFF.loc[country_of[city_b_node]]['tariff'] # Tariffs at destination [ad valorem]
+# 7b. Split costs into parts and count the use of each edge
+#---------------------------------------------------
+ROUTE_PARTS = ['transport', 'border', 'port'] # Parts of the network cost, by the quality of each edge
 
-            if country_of[city_a_node] == country_of[city_b_node]:
-                final_cost = transport_cost
-            else:
-                final_cost = transport_cost + tariff
 
-            costs_cities.append(final_cost)
+def route_parts(G, cities):
+    # RouteParts for routing on the CSR graph of the Network G. Edge use is
+    #  counted in city pairs and in GDP of the origin times GDP of the
+    #  destination, summed over the pairs.
+    edges = G.csr_edges()
+    part = np.select([G.quality[edges] == 'border_crossing', G.quality[edges] == 'port_fee'], [1, 2], 0)
+    entry_parts = np.zeros((len(edges), len(ROUTE_PARTS)))
+    entry_parts[np.arange(len(edges)), part] = G.cost[edges]
 
-        matrix_dict[city_a] = costs_cities
+    gdp = cities['GDP'].to_numpy(dtype=np.float64)
+    origin_weights = np.column_stack([np.ones(len(gdp)), gdp])
+    target_weights = np.zeros((G.number_of_nodes(), origin_weights.shape[1]))
+    np.add.at(target_weights, G.node_ids(city_nodes(cities)[0]), origin_weights)
+    return RouteParts(entry_parts, origin_weights, target_weights)
 
-    print('\r100% done.   Elapsed: {:.1f}m    Time remain: {:.1f}m    Avg {:.2f} s/iter...'.format(
-        (time.time()- t_0)/60,
-        (n_iter-counter)*(time.time()- t_0)/(60 * counter), 
-        (time.time()- t_0)/counter))
 
-    matrix = pd.DataFrame.from_dict(matrix_dict, orient='index')
-    matrix.columns = all_cities
+def part_file(filename, part):
+    # e.g. data/csv/cm.csv -> data/csv/cm_border.csv
+    root, ext = os.path.splitext(filename)
+    return root + '_' + part + ext
 
-    return matrix
+
+def write_routes(G, cities, routes, part_matrices, filename):
+    # Part matrices in the format of the cost matrix, and the edges that
+    #  carry at least one city pair as a CSV
+    for part, matrix in part_matrices.items():
+        if isinstance(matrix, MatrixWriter):
+            matrix.close()
+        else:
+            write_matrix(pd.DataFrame(matrix, index=cities['ORIG_FID'], columns=cities['ORIG_FID']),
+                part_file(filename, part), dtype=args.dtype)
+    logger.info('Cost parts exported to {}.'.format(', '.join(part_file(filename, part) for part in part_matrices)))
+
+    edges = G.csr_edges()
+    used = routes.usage[:, 0] > 0
+    order = np.argsort(edges[used])
+    edges, usage = edges[used][order], routes.usage[used][order]
+    tails, heads = G.tail[edges], G.head[edges]
+    edge_use = pd.DataFrame({
+        'from_x': G.x[tails], 'from_y': G.y[tails], 'from_iso': G.iso[tails],
+        'to_x': G.x[heads], 'to_y': G.y[heads], 'to_iso': G.iso[heads],
+        'quality': G.quality[edges], 'iso3': G.iso3[edges], 'cost': G.cost[edges],
+        'city_pairs': usage[:, 0].round().astype(np.int64), 'gdp_flow': usage[:, 1],
+        })
+    edge_use.to_csv(os.path.splitext(filename)[0] + '_edges.csv', index=False)
+    logger.info('{} of {} edges carry at least one city pair.'.format(len(edges), G.number_of_edges()))
+    record(edges_used=len(edges))
+#---------------------------------------------------
+
+
+# Network cache
+#---------------------------------------------------
+def hash_files(filenames, *extra):
+    h = hashlib.sha1(str((CACHE_VERSION,) + extra).encode())
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def topology_key(road_file=ROAD_FILE):
+    return hash_files([road_file, SEA_FILE, PORTS_FILE, CITIES_CSV])
+
+
+def cost_key():
+    return hash_files(COST_FILES, args.time)
+
+
+def cache_file(topology_key):
+    return os.path.join(args.cache_dir, 'network_{}.pkl'.format(topology_key[:16]))
+
+
+def distances_file(road_file=ROAD_FILE):
+    return os.path.join(args.cache_dir, 'distances_{}_{}.pkl'.format(topology_key(road_file)[:16], cost_key()[:16]))
+
+
+def read_cache(road_file=ROAD_FILE):
+    # Returns the cached network if the topology inputs have not changed,
+    #  reweighting it if only the cost parameters have.
+    if args.no_cache or args.force_rematch:
+        return None
+    filename = cache_file(topology_key(road_file))
+    if not os.path.exists(filename):
+        return None
+
+    logger.info('Reading cached network from {}...'.format(filename))
+    with open(filename, 'rb') as f:
+        cache = pickle.load(f)
+    if cache['cost_key'] != cost_key():
+        cache['G'] = reweight_graph(cache['G'])
+    return cache
+
+
+def write_cache(G, cities, ports, road_file=ROAD_FILE):
+    if args.no_cache:
+        return
+    # Matching may have rewritten CITIES_CSV, so hash the files again
+    filename = cache_file(topology_key(road_file))
+    os.makedirs(args.cache_dir, exist_ok=True)
+    with open(filename, 'wb') as f:
+        pickle.dump({
+            'cost_key': cost_key(),
+            'G': G,
+            'cities': cities,
+            'ports': ports,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+    logger.info('Network cached at {}.'.format(filename))
+
+
+def read_distances(road_file=ROAD_FILE):
+    # Raw network costs between city nodes from an earlier run on the same
+    #  network and costs, as (nodes, array) with dist[i, j] from nodes[i]
+    #  to nodes[j]
+    filename = distances_file(road_file)
+    if args.no_cache or not os.path.exists(filename):
+        return None
+    logger.info('Reading cached city distances from {}...'.format(filename))
+    with open(filename, 'rb') as f:
+        cache = pickle.load(f)
+    return cache['nodes'], cache['dist']
+
+
+def write_distances(nodes, dist, road_file=ROAD_FILE):
+    if args.no_cache:
+        return
+    os.makedirs(args.cache_dir, exist_ok=True)
+    with open(distances_file(road_file), 'wb') as f:
+        pickle.dump({'nodes': nodes, 'dist': dist}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def overlay_file(road_file=ROAD_FILE):
+    # The index only depends on the costs of the edges that are not fees
+    key = hash_files(['parameters/transport_costs.csv', 'parameters/transport_speeds.csv'],
+        args.time, args.contract, OVERLAY_VERSION, topology_key(road_file))
+    return os.path.join(args.cache_dir, 'overlay_{}.pkl'.format(key[:16]))
+
+
+def overlay_index(G, R, cities, road_file=ROAD_FILE):
+    # Index for the overlay engine, read from the cache if it was built
+    #  for the same network and city nodes, or built on R and cached
+    target_nodes = city_nodes(cities)[1]
+    filename = overlay_file(road_file)
+    if not args.no_cache and os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            index = pickle.load(f)
+        if index.target_nodes == target_nodes:
+            logger.info('Read overlay index from {}.'.format(filename))
+            return index
+
+    index = OverlayIndex.build(fixed_csr(R), target_nodes, fee_edges(G))
+    if not args.no_cache:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        with open(filename, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        logger.info('Overlay index cached at {}.'.format(filename))
+    return index
+
+
+def record_distances(origin_costs, origin_nodes, target_nodes, rows):
+    # Passes the routing results through, keeping each origin's costs to
+    #  the target nodes in rows
+    for node, costs in zip(origin_nodes, origin_costs):
+        rows[node] = target_costs(costs, target_nodes)
+        yield costs
 #---------------------------------------------------
 
 
 # Wrapper functions
 #---------------------------------------------------
-def setup():
-    road, rail, sea, G = read_geojsons()
-    cities, road_nodes, rail_nodes, sea_nodes, any_nodes = match_cities_with_nodes(road, rail, sea, G)
+def setup(road_file=ROAD_FILE):
+    cache = read_cache(road_file)
+    if cache is not None:
+        # Only the composed graph is cached, not the separate layers
+        return None, None, None, cache['G'], cache['cities']
+
+    road, rail, sea, G = read_geojsons(road_file)
+    road_index, sea_index = NodeIndex(G, road), NodeIndex(G, sea) # Shared by cities and ports
+    cities = match_cities_with_nodes(road, rail, sea, G, road_index, sea_index)
     G = add_costs_to_graph(G)
     # G = create_road_rail_transfers(cities, G)
-    ports = find_nearest_nodes_to_ports(road, rail, sea, G)
+    ports = find_nearest_nodes_to_ports(road, rail, sea, G, road_index, sea_index)
     G = create_sea_transfers(ports, G)
-    G = create_border_crossings(road_nodes, G)
-    pickle.dump([(e, G[e[0]][e[1]]['cost'], G[e[1]][e[0]]['cost']) for e in G.edges], open('test', 'wb'))
+    G = create_border_crossings(road, G)
+    write_cache(G, cities, ports, road_file)
     # G, externals = set_up_external_markets(ports, G)
     # with open('edges.txt', 'w') as f:
     #     f.writelines([str(e)+'\n' for e in list(G.edges)])
@@ -380,16 +779,125 @@ def setup():
 
 def main(road, rail, sea, G, cities):    
     logger.info('# of nodes: {}, # of edges: {}'.format(G.number_of_nodes(), G.number_of_edges()))
-    
+    record(nodes=G.number_of_nodes(), edges=G.number_of_edges(), cities=len(cities))
+    origin_nodes, target_nodes = city_nodes(cities)
 
-    logger.info('7. Calculating cost matrices...')
-    cost_matrix = get_cost_matrix(cities, G)
+    R = contract_graph(G, cities) if args.contract else G # Network to route on
+    compiled = overlay_index(G, R, cities) if args.engine == 'overlay' else None
 
-    cost_matrix.to_csv(args.outfile)
+    logger.info('7. Calculating cost matrices...')
+    routes = route_parts(G, cities) if args.routes else None
+    if args.baseline_road_file:
+        origin_costs = update_baseline(G, R, cities, compiled)
+    else:
+        origin_costs = route(R, origin_nodes, target_nodes, compiled=compiled, limit=ROUTE_LIMIT, settled=settled_counts(), routes=routes)
+
+    # Keep the raw city to city costs, so later scenarios can start from
+    #  them. Not with a cutoff, since they would be incomplete, and not
+    #  with --out_of_core, since they would be held in memory.
+    keep_distances = MAX_COST is None and not args.out_of_core
+    rows = {}
+    if keep_distances:
+        origin_costs = record_distances(origin_costs, origin_nodes, target_nodes, rows)
+    cost_matrix = get_cost_matrix(cities, G, origin_costs=origin_costs, outfile=args.outfile if args.out_of_core else None,
+        routes=routes, routes_file=args.outfile if args.routes else None)
+    if keep_distances:
+        write_distances(target_nodes, np.array([rows[node] for node in target_nodes], dtype=np.float64))
+
+    if not args.out_of_core:
+        write_matrix(cost_matrix, args.outfile, dtype=args.dtype)
 
     logger.info('All done.')
     return cost_matrix
+
+
+def update_baseline(G, R, cities, compiled=None):
+    # Start from the city costs on the baseline network and only route
+    #  again (on R, G or its contracted copy) from the cities whose costs
+    #  the changed roads can affect. Yields a {node: cost} dict per city
+    #  like route().
+    logger.info('Comparing with baseline network {}...'.format(args.baseline_road_file))
+    origin_nodes, target_nodes = city_nodes(cities)
+    _, _, _, G_base, cities_base = setup(args.baseline_road_file)
+
+    if cities_base['nearest_any'].tolist() != origin_nodes:
+        logger.warning('Cities are matched to different nodes in the baseline, calculating all rows.')
+        return route(R, origin_nodes, target_nodes, compiled=compiled, limit=ROUTE_LIMIT, settled=settled_counts())
+
+    baseline = read_distances(args.baseline_road_file)
+    if baseline is None or baseline[0] != target_nodes:
+        logger.info('No cached baseline costs, calculating them...')
+        rows = {}
+        for costs in record_distances(route(G_base, target_nodes, target_nodes), target_nodes, target_nodes, rows):
+            pass
+        baseline = (target_nodes, np.array([rows[node] for node in target_nodes], dtype=np.float64))
+        write_distances(*baseline, road_file=args.baseline_road_file)
+    base_dist = baseline[1]
+
+    # The comparison still works on networkx graphs
+    G_base, G = G_base.to_networkx(), G.to_networkx()
+    better, worse = changed_edges(G_base, G, weight='cost')
+    update = rows_to_update(G_base, G, target_nodes, base_dist, better, worse, weight='cost')
+    logger.info('{} edges cheaper or new, {} dearer or removed. Recalculating {} of {} origins.'.format(
+        len(better), len(worse), update.sum(), len(target_nodes)))
+    record(rows_recalculated=int(update.sum()))
+
+    update_nodes = [node for node, flag in zip(target_nodes, update) if flag]
+    new_costs = {node: target_costs(costs, target_nodes)
+        for node, costs in zip(update_nodes, route(R, update_nodes, target_nodes, compiled=compiled, limit=ROUTE_LIMIT, settled=settled_counts()))}
+    base_costs = dict(zip(target_nodes, base_dist))
+    return (new_costs[node] if node in new_costs else base_costs[node] for node in origin_nodes)
+
+
+def run_scenarios(G, cities):
+    # Border costs and tariffs do not change the network, so build it once
+    #  and only update the border and port fees for each scenario.
+    #  Tariffs are only used when assembling the matrix.
+    global BCOST, TARIFF
+    scenarios = pd.read_csv(args.scenario_file).fillna('')
+    logger.info('# of nodes: {}, # of edges: {}'.format(G.number_of_nodes(), G.number_of_edges()))
+    record(nodes=G.number_of_nodes(), edges=G.number_of_edges(), cities=len(cities), scenarios=len(scenarios))
+    logger.info('Running {} scenarios from {}...'.format(len(scenarios), args.scenario_file))
+
+    fees = fee_edges(G)
+    R = contract_graph(G, cities) if args.contract else G # Network to route on, keeps all fee edges
+    compiled = None
+    if args.engine == 'csr':
+        compiled = to_csr(R)
+    elif args.engine == 'overlay':
+        compiled = overlay_index(G, R, cities)
+
+    for i, scenario in scenarios.iterrows():
+        bcost_file = scenario['bcost_file'] or args.bcost_file
+        tariff_file = scenario.get('tariff_file') or 'parameters/tariffs.csv'
+        logger.info('Scenario {} of {}: border costs {}, tariffs {}'.format(i+1, len(scenarios), bcost_file, tariff_file))
+        BCOST = pd.read_csv(bcost_file).set_index('iso3')
+        TARIFF = pd.read_csv(tariff_file).set_index('iso3')
+
+        G = reweight_graph(G, fees_only=True)
+        costs = G.cost[G.is_fee()] # In the order of fees
+        if R is not G:
+            for (u, v), cost in zip(fees, costs):
+                R[u][v]['cost'] = cost
+        if args.engine == 'csr':
+            reweight_csr(compiled[2], compiled[1], fees, costs)
+
+        logger.info('7. Calculating cost matrices...')
+        routes_file = scenario['outfile'] if args.routes else None
+        if args.out_of_core:
+            get_cost_matrix(cities, R, compiled, outfile=scenario['outfile'], routes_file=routes_file)
+            continue
+        cost_matrix = get_cost_matrix(cities, R, compiled, routes_file=routes_file)
+        write_matrix(cost_matrix, scenario['outfile'], dtype=args.dtype)
+        logger.info('Exported to {}.'.format(scenario['outfile']))
+
+    logger.info('All done.')
 #---------------------------------------------------
 
 road, rail, sea, G, cities = setup()
-cost_matrix = main(road, rail, sea, G, cities)
\ No newline at end of file
+if args.scenario_file:
+    run_scenarios(G, cities)
+else:
+    cost_matrix = main(road, rail, sea, G, cities)
+if REPORT is not None:
+    REPORT.finish()
\ No newline at end of file
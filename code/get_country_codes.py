@@ -2,15 +2,55 @@
 # January 2019
 # trub@uchicago.edu
 
-import json
+import argparse
+import logging
+import os
+import re
+from geojson_io import iter_features, write_features
 
-with open('data/geojson/admin2_poly.geojson', 'r') as f:
-    admin2_poly = json.load(f)
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-for feature in admin2_poly['features']:
-    other_tags = {eval(kv.split('=>')[0]): eval(kv.split('=>')[1]) for kv in feature['properties']['other_tags'].split(',')}
-    iso3 = other_tags['ISO3166-1:alpha3']
-    feature['properties']['iso3'] = iso3
+parser = argparse.ArgumentParser()
+parser.add_argument('--infile', '-i', help='Set country polygons from ogr2ogr (default: data/geojson/admin2_poly.geojson)', type=str, default='data/geojson/admin2_poly.geojson')
+parser.add_argument('--outfile', '-o', help='Set country polygons with iso3 (default: data/geojson/admin2_poly_iso3.geojson)', type=str, default='data/geojson/admin2_poly_iso3.geojson')
+args = parser.parse_args()
+ISO3_TAG = 'ISO3166-1:alpha3'
 
-with open('data/geojson/admin2_poly.geojson', 'w') as f:
-    json.dump(admin2_poly, f)
\ No newline at end of file
+if os.path.abspath(args.infile) == os.path.abspath(args.outfile):
+    parser.error('The output file must be different from the input file.')
+
+# ogr2ogr writes the OSM tags without their own column as "key"=>"value","key"=>"value"
+#  with quotes and backslashes inside keys and values escaped by a backslash
+TAG_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"=>"((?:[^"\\]|\\.)*)"')
+ESCAPE_PATTERN = re.compile(r'\\(.)')
+
+
+def parse_tags(other_tags):
+    return {ESCAPE_PATTERN.sub(r'\1', key): ESCAPE_PATTERN.sub(r'\1', value)
+        for key, value in TAG_PATTERN.findall(other_tags or '')}
+
+
+def add_iso3(features, missing):
+    for feature in features:
+        iso3 = parse_tags(feature['properties'].get('other_tags')).get(ISO3_TAG)
+        if iso3 is None:
+            missing.append(feature['properties'].get('name'))
+        feature['properties']['iso3'] = iso3
+        yield feature
+
+
+logger.info('Adding country codes to {}, writing to {}...'.format(args.infile, args.outfile))
+members = {}
+missing = []
+try:
+    write_features(args.outfile + '.tmp', add_iso3(iter_features(args.infile, members=members), missing), members)
+except Exception:
+    if os.path.exists(args.outfile + '.tmp'):
+        os.remove(args.outfile + '.tmp')
+    raise
+os.replace(args.outfile + '.tmp', args.outfile) # Only replace the output once every feature is written
+if missing:
+    logger.warning('{} features have no {} tag, their iso3 is null (first ones: {}).'.format(
+        len(missing), ISO3_TAG, ', '.join(map(str, missing[:5]))))
+logger.info('All done.')
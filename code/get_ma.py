@@ -2,6 +2,7 @@
 # January 2019
 # trub@uchicago.edu
 
+import sys
 import time
 import logging
 import argparse
@@ -11,19 +12,28 @@ import pandas as pd
 import networkx as nx
 from scipy import spatial, special
 from tqdm import tqdm, tqdm_pandas
+from matrix_io import open_matrix, read_matrix, row_blocks, write_table
+from run_report import RunReport, report_file
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 tqdm.pandas() # Gives us nice progress bars
 parser = argparse.ArgumentParser() # Allows user to put no-borders in command line
-parser.add_argument('--infile', '-i', help='Set location of input cost matrix', type=str, default='data/csv/cost_matrix.csv')
+parser.add_argument('--infile', '-i', help='Set location of input cost matrix (.csv, .npy or .parquet)', type=str, default='data/csv/cost_matrix.csv')
 parser.add_argument('--outfile', '-o', help='Set output location', type=str, default='output/market_access.csv')
 parser.add_argument('--harris', '-harris', help='Calculate MA for Harris 1954-style market potential (theta=1)', action='store_true')
+parser.add_argument('--sweep_theta', help='Calculate MA for each of these theta values (writes a long table)', type=float, nargs='+')
+parser.add_argument('--sweep_beta', help='Calculate MA for each of these beta values (writes a long table)', type=float, nargs='+')
+parser.add_argument('--sweep_harris', help='Also calculate Harris 1954-style market potential in the sweep', action='store_true')
+parser.add_argument('--block_rows', help='Read the .npy cost matrix this many rows at a time instead of all at once (0 picks a size)', type=int)
+parser.add_argument('--no_report', help='Do not write the run report (timing and memory of each step) next to the output', action='store_true')
+parser.add_argument('--profile', help='Profile the run and add the hottest functions to the run report', action='store_true')
 args = parser.parse_args()
 
 # 0. Make assumptions, set file names
 #---------------------------------------------------
+REPORT = None if args.no_report else RunReport('get_ma.py', sys.argv[1:], report_file(args.outfile), profile=args.profile)
 PARAMS = pd.read_csv('parameters/market_access_parameters.csv').set_index('parameter').to_dict()['value']
 if args.harris:
     PARAMS['theta'] = 1
@@ -36,19 +46,45 @@ logger.info('File will export to {}.'.format(args.outfile))
 # 1. Read cost matrices
 #---------------------------------------------------
 def read_cost_matrix():
-    logger.info('Reading cost matrix...')
-    matrix = pd.read_csv(args.infile, index_col=0)
+    logger.info('1. Reading cost matrix...')
+    matrix = read_matrix(args.infile)
     matrix.index = matrix.index.astype(str) # Just in case...
-    # Minimum cost, to prevent crazy values for cities that happen to be very close to each other
-    matrix = matrix.clip(lower=PARAMS['min_cost'])
+    matrix.columns = matrix.columns.astype(str)
+    # Minimum cost, to prevent crazy values for cities that happen to be very close to each other.
+    #  Pairs set to -1 (e.g. beyond the cutoff of get_cost_matrix.py) stay -1 so MA skips them.
+    matrix = matrix.where(matrix < 0, matrix.clip(lower=PARAMS['min_cost']))
+    skipped = int((matrix.to_numpy() < 0).sum())
+    if skipped:
+        logger.info('{} city pairs set to -1 will be skipped.'.format(skipped))
     return matrix
+
+
+def read_cost_blocks(cities):
+    # Yields (rows, costs) for a block of origin rows at a time, in the
+    #  order of cities, with costs clipped like read_cost_matrix(). Only
+    #  one block of the memory-mapped matrix is in memory at a time.
+    logger.info('Reading cost matrix {} in blocks...'.format(args.infile))
+    ids, matrix = open_matrix(args.infile)
+    order = pd.Index(ids.astype(str)).get_indexer(cities[UNIQUE_FIELD].astype(str))
+    if (order < 0).any():
+        raise KeyError('{} cities are not in the cost matrix'.format((order < 0).sum()))
+    in_order = np.array_equal(order, np.arange(len(ids)))
+
+    skipped = 0
+    for rows in row_blocks(len(order), len(order), args.block_rows):
+        costs = matrix[rows] if in_order else matrix[order[rows]][:, order]
+        costs = np.where(costs < 0, costs, np.maximum(costs, np.asarray(PARAMS['min_cost'], dtype=costs.dtype)))
+        skipped += int((costs < 0).sum())
+        yield rows, costs.astype(np.float64)
+    if skipped:
+        logger.info('{} city pairs set to -1 were skipped.'.format(skipped))
 #---------------------------------------------------
 
 
 # 2. Read cities and external markets
 #---------------------------------------------------
 def read_cities_and_externals():
-    logger.info('Reading cities...')
+    logger.info('2. Reading cities...')
     cities = pd.read_csv(CITIES_CSV)
     externals = {}
     return cities, externals
@@ -57,66 +93,137 @@ def read_cities_and_externals():
 
 # 3. Run MA
 #---------------------------------------------------
-def calc_market_access(city_i, cost_matrix, cities, externals):
-    FMA, CMA = 0, 0
+def sum_over_cities(terms):
+    # Adds up terms[o, i] over o one city at a time, in city order, like a
+    #  plain loop would. np.sum adds in a different order, which changes
+    #  the last digits of the result.
+    return np.cumsum(terms, axis=0)[-1]
+
+
+def prepare_costs(cost_matrix, cities):
+    # Everything in the MA sums that does not depend on theta. costs[o, i]
+    #  is the cost from city o to city i, in the order of cities.
+    ids = cities[UNIQUE_FIELD].astype(str)
+    costs = cost_matrix.loc[ids, ids].to_numpy(dtype=np.float64)
+    gdp = cities['GDP'].to_numpy(dtype=np.float64)[:, None]
+
+    # Skip each city itself and city pairs where cost is set to -1, a dummy value
+    skip = costs < 0
+    np.fill_diagonal(skip, True)
+    return gdp, skip, costs, costs + 1
+
+
+def market_access(gdp, skip, costs, costs_plus_one, theta, harris):
+    # Firm and consumer market access of every city at once, as in
+    #  Donaldson & Hornbeck 2016. FMA sums over column i, CMA over row i.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if harris:
+            fma_terms = gdp / costs # Firm Market Access
+            cma_terms = gdp / costs.T # Consumer Market Access
+        else:
+            # float_power rounds like the scalar ** of the old loop. On
+            #  CPUs with AVX-512, ** on arrays is off by one ulp for ~5% of terms.
+            fma_terms = gdp * np.float_power(costs_plus_one, -theta) # Firm Market Access
+            cma_terms = gdp * np.float_power(costs_plus_one.T, -theta) # Consumer Market Access
+    fma_terms[skip] = 0
+    cma_terms[skip.T] = 0 # Each direction is skipped on its own cost
+
+    FMA = sum_over_cities(fma_terms)
+    CMA = sum_over_cities(cma_terms)
+    return np.maximum(FMA, 1e-99), np.maximum(CMA, 1e-99) # in case MA = 0, prevent division errors later
+
 
-    # First get external market terms
+def calc_market_access(cost_matrix, cities, externals):
     if externals:
-        for ext in externals:
-            travel_cost_id = cost_matrix.loc[city_i][ext] # Cost to export from i -> d
-            travel_cost_oi = cost_matrix.loc[ext][city_i] # Cost to import from o -> i
-
-            FMA = (1/travel_cost_id)**theta * externals[ext]['GDP'] # Firm Market Access
-            CMA = (1/travel_cost_oi)**theta * externals[ext]['GDP'] # Consumer Market Access
-
-    # Then add terms for all other cities as in Donaldson & Hornbeck 2016
-    t0 = time.time()
-    for i in range(len(cities)):
-        logger.debug(city_i, i, cities.iloc[i][UNIQUE_FIELD])
-        logger.debug(time.time())
-        
-        other_city = str(cities.iloc[i][UNIQUE_FIELD])
-        if other_city == city_i:
-            continue
+        logger.warning('External markets are not implemented, ignoring them.')
+    if args.block_rows is not None:
+        FMA, CMA = block_market_access(read_cost_blocks(cities), cities['GDP'].to_numpy(dtype=np.float64), [(PARAMS['theta'], args.harris)])
+        return FMA[0], CMA[0]
+    return market_access(*prepare_costs(cost_matrix, cities), PARAMS['theta'], args.harris)
 
-        else:
-            travel_cost_id = cost_matrix.loc[other_city][city_i]
-            travel_cost_oi = cost_matrix.loc[city_i][other_city]
-
-            if travel_cost_id < 0: # Skip city pairs where cost is set to -1, a dummy value
-                continue
-
-        if args.harris:
-            logger.debug('        ', time.time())
-            FMA += cities.iloc[i]['GDP'] / travel_cost_id # Firm Market Access
-            logger.debug('FMA done', time.time())
-            CMA += cities.iloc[i]['GDP'] / travel_cost_oi # Consumer Market Access
-            logger.debug('CMA done', time.time())
-        else:
-            logger.debug('        ', time.time())
-            FMA += cities.iloc[i]['GDP'] * (travel_cost_id + 1)**(-PARAMS['theta']) # Firm Market Access
-            logger.debug('FMA done', time.time())
-            CMA += cities.iloc[i]['GDP'] * (travel_cost_oi + 1)**(-PARAMS['theta']) # Consumer Market Access
-            logger.debug('CMA done', time.time())
-
-    return max([FMA, 1e-99]), max([CMA, 1e-99]) # in case MA = 0, prevent division errors later
-
-def add_ma_cols(row, matrix, cities, externals):
-    current_city_id = str(row[UNIQUE_FIELD])
-    FMA, CMA = calc_market_access(current_city_id, matrix, cities, externals)
-    row['ln MA'] = (1-PARAMS['beta'])*np.log(FMA) + PARAMS['beta']*np.log(CMA) # Initial overall market access
+
+def add_ma_cols(cities, matrix, externals):
+    FMA, CMA = calc_market_access(matrix, cities, externals)
+    cities['ln MA'] = (1-PARAMS['beta'])*np.log(FMA) + PARAMS['beta']*np.log(CMA) # Initial overall market access
     
-    return row
+    return cities
+
+
+def block_market_access(blocks, gdp, runs):
+    # Same as market_access() for each (theta, harris) in runs, from one
+    #  pass over blocks of origin rows. FMA adds up each block's rows in
+    #  order, and CMA of a block's origins only needs that block, so the
+    #  sums are the same as with the whole matrix.
+    FMA = np.zeros((len(runs), len(gdp)))
+    CMA = np.zeros((len(runs), len(gdp)))
+    for rows, costs in blocks:
+        skip = costs < 0
+        skip[np.arange(len(costs)), np.arange(rows.start, rows.stop)] = True
+        costs_plus_one = costs + 1
+        for k, (theta, harris) in enumerate(runs):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if harris:
+                    fma_terms = gdp[rows, None] / costs # Firm Market Access of every destination
+                    cma_terms = gdp[None, :] / costs # Consumer Market Access of these origins
+                else:
+                    factor = np.float_power(costs_plus_one, -theta)
+                    fma_terms = gdp[rows, None] * factor
+                    cma_terms = gdp[None, :] * factor
+            fma_terms[skip] = 0
+            cma_terms[skip] = 0
+            for row in fma_terms:
+                FMA[k] += row
+            CMA[k, rows] = np.add.accumulate(cma_terms, axis=1)[:, -1]
+    return np.maximum(FMA, 1e-99), np.maximum(CMA, 1e-99) # in case MA = 0, prevent division errors later
+
+
+def sweep_market_access(matrix, cities, thetas, betas, harris):
+    # MA for every theta and beta, as a long table with one row per city
+    #  and parameter set. The costs are prepared once, FMA and CMA are
+    #  calculated once per theta, and every beta reuses them.
+    runs = [(theta, False) for theta in thetas]
+    if harris:
+        runs.append((1, True))
+    if args.block_rows is not None:
+        results = zip(*block_market_access(read_cost_blocks(cities), cities['GDP'].to_numpy(dtype=np.float64), runs))
+    else:
+        prepared = prepare_costs(matrix, cities)
+        results = (market_access(*prepared, theta, is_harris) for theta, is_harris in tqdm(runs))
+
+    tables = []
+    for (theta, is_harris), (FMA, CMA) in zip(runs, results):
+        for beta in betas:
+            tables.append(pd.DataFrame({
+                UNIQUE_FIELD: cities[UNIQUE_FIELD],
+                'theta': theta,
+                'beta': beta,
+                'harris': is_harris,
+                'ln FMA': np.log(FMA),
+                'ln CMA': np.log(CMA),
+                'ln MA': (1-beta)*np.log(FMA) + beta*np.log(CMA),
+                }))
+    return pd.concat(tables, ignore_index=True)
 
 #---------------------------------------------------
 
-matrix = read_cost_matrix()
+matrix = read_cost_matrix() if args.block_rows is None else None # Read later, in blocks
 cities, externals = read_cities_and_externals()
-
-logger.info('3. Calculating market access...')
-cities = cities.progress_apply(add_ma_cols, axis=1, args=(matrix, cities, externals))    
+if REPORT is not None:
+    REPORT.record(cities=len(cities), matrix_cells=len(cities)**2)
+
+if args.sweep_theta or args.sweep_beta or args.sweep_harris:
+    thetas = args.sweep_theta or [PARAMS['theta']]
+    betas = args.sweep_beta or [PARAMS['beta']]
+    logger.info('3. Calculating market access for {} theta and {} beta values{}...'.format(
+        len(thetas), len(betas), ' and Harris' if args.sweep_harris else ''))
+    cities = sweep_market_access(matrix, cities, thetas, betas, args.sweep_harris)
+else:
+    logger.info('3. Calculating market access...')
+    cities = add_ma_cols(cities, matrix, externals)
 logger.info('\nMarket access calculated.')
 
 logger.info('4. Exporting to {}...'.format(args.outfile))
-cities.to_csv(args.outfile, index=False)
-logger.info('All done.')
\ No newline at end of file
+write_table(cities, args.outfile)
+logger.info('All done.')
+if REPORT is not None:
+    REPORT.finish()
\ No newline at end of file
@@ -1,18 +1,49 @@
-import json
+import argparse
+import logging
+import os
 import pandas as pd
+from geojson_io import iter_features, write_features
 
-qualities = pd.read_csv('parameters/road_quality.csv').set_index('code')
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
-with open('data/geojson/roads.geojson', 'r') as f:
-    roads = json.load(f)
+parser = argparse.ArgumentParser()
+parser.add_argument('--infile', '-i', help='Set roads file split by country (default: data/geojson/roads_by_country.geojson)', type=str, default='data/geojson/roads_by_country.geojson')
+parser.add_argument('--outfile', '-o', help='Set roads file with quality (default: data/geojson/roads.geojson)', type=str, default='data/geojson/roads.geojson')
+parser.add_argument('--quality_file', '-q', help='Set file with road quality by country and OSM class (default: parameters/road_quality.csv)', type=str, default='parameters/road_quality.csv')
+args = parser.parse_args()
+LOG_EVERY = 100000
 
-for i, feature in enumerate(roads['features']):
-    print('Feature {} of {}...'.format(i+1, len(roads['features'])))
-    country = feature['properties']['iso3']
-    osm_highway = feature['properties']['highway']
-    
-    feature['properties']['quality'] = int(qualities.loc[country, osm_highway])
+if os.path.abspath(args.infile) == os.path.abspath(args.outfile):
+    parser.error('The output file must be different from the input file.')
 
 
-with open('data/geojson/roads.geojson', 'w') as f:
-    json.dump(roads, f)
\ No newline at end of file
+def quality_lookup():
+    # (iso3, highway) -> quality, for every cell of the quality table
+    qualities = pd.read_csv(args.quality_file).set_index('code').stack()
+    return {key: int(quality) for key, quality in qualities.items()}
+
+
+def add_quality(features, lookup):
+    for i, feature in enumerate(features):
+        properties = feature['properties']
+        key = (properties['iso3'], properties['highway'])
+        if key not in lookup:
+            raise ValueError('No road quality for country {} and OSM class {} (feature {}) in {}.'.format(
+                *key, i+1, args.quality_file))
+        properties['quality'] = lookup[key]
+        if (i+1) % LOG_EVERY == 0:
+            logger.info('{} features done...'.format(i+1))
+        yield feature
+
+
+logger.info('Adding road quality to {}, writing to {}...'.format(args.infile, args.outfile))
+members = {}
+try:
+    write_features(args.outfile + '.tmp', add_quality(iter_features(args.infile, members=members), quality_lookup()), members)
+except Exception:
+    if os.path.exists(args.outfile + '.tmp'):
+        os.remove(args.outfile + '.tmp')
+    raise
+os.replace(args.outfile + '.tmp', args.outfile) # Only replace the output once every feature has a quality
+logger.info('All done.')
@@ -0,0 +1,112 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Cost matrices are square DataFrames indexed both ways by city ID. They
+#  can be stored as CSV, as a .npy array with the IDs in a .ids.npy file
+#  next to it, or as Parquet (needs pyarrow or fastparquet). The format is
+#  chosen from the file extension when writing and from the file contents
+#  when reading.
+NPY_MAGIC = b'\x93NUMPY'
+PARQUET_MAGIC = b'PAR1'
+BLOCK_CELLS = 2**22 # Matrix cells handled at a time when working in blocks (32 MB of float64)
+
+
+def ids_file(filename):
+    return os.path.splitext(filename)[0] + '.ids.npy'
+
+
+def matrix_format(filename):
+    with open(filename, 'rb') as f:
+        magic = f.read(6)
+    if magic.startswith(NPY_MAGIC):
+        return 'npy'
+    if magic.startswith(PARQUET_MAGIC):
+        return 'parquet'
+    return 'csv'
+
+
+def write_matrix(matrix, filename, dtype='float64'):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.npy':
+        ids = np.asarray(matrix.index)
+        if ids.dtype == object:
+            ids = ids.astype(str)
+        np.save(filename, np.ascontiguousarray(matrix.to_numpy(dtype=dtype))) # Row by row on disk, so blocks of rows are read in one go
+        np.save(ids_file(filename), ids)
+    elif ext == '.parquet':
+        matrix = matrix.astype(dtype)
+        matrix.columns = matrix.columns.astype(str) # Parquet needs string column names
+        matrix.to_parquet(filename)
+    else:
+        matrix.astype(dtype).to_csv(filename)
+
+
+def read_matrix(filename):
+    # .npy matrices are memory-mapped, so only the parts that are used
+    #  get read from disk
+    fmt = matrix_format(filename)
+    if fmt == 'npy':
+        ids = np.load(ids_file(filename))
+        return pd.DataFrame(np.load(filename, mmap_mode='r'), index=ids, columns=ids)
+    if fmt == 'parquet':
+        return pd.read_parquet(filename)
+    return pd.read_csv(filename, index_col=0)
+
+
+class MatrixWriter:
+    # Writes a .npy matrix one row at a time, in order, so only the row
+    #  being written is ever in memory
+    def __init__(self, filename, ids, dtype='float64'):
+        if os.path.splitext(filename)[1].lower() != '.npy':
+            raise ValueError('Matrices written row by row must be .npy, not {}'.format(filename))
+        ids = np.asarray(ids)
+        if ids.dtype == object:
+            ids = ids.astype(str)
+        np.save(ids_file(filename), ids)
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.shape = (len(ids), len(ids))
+        self.rows = 0
+        self.f = open(filename, 'wb')
+        np.lib.format.write_array_header_1_0(self.f,
+            {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': self.shape})
+
+    def write(self, row):
+        self.f.write(np.asarray(row, dtype=self.dtype).tobytes())
+        self.rows += 1
+
+    def close(self):
+        self.f.close()
+        if self.rows != self.shape[0]:
+            raise ValueError('{} has {} of {} rows'.format(self.filename, self.rows, self.shape[0]))
+
+
+def open_matrix(filename):
+    # IDs and memory-mapped array of a .npy matrix, without a DataFrame.
+    #  Pages that have been read stay cached by the OS, but they are freed
+    #  when memory is needed.
+    if matrix_format(filename) != 'npy':
+        raise ValueError('Matrices read in blocks must be .npy, not {}'.format(filename))
+    return np.load(ids_file(filename)), np.load(filename, mmap_mode='r')
+
+
+def row_blocks(n_rows, n_cols, block_rows=None):
+    # Slices of rows covering about BLOCK_CELLS cells each, or block_rows rows
+    block_rows = block_rows or max(1, BLOCK_CELLS // max(1, n_cols))
+    for start in range(0, n_rows, block_rows):
+        yield slice(start, min(start + block_rows, n_rows))
+
+
+def read_table(filename):
+    # City tables (e.g. market access output) as CSV or Parquet
+    if matrix_format(filename) == 'parquet':
+        return pd.read_parquet(filename)
+    return pd.read_csv(filename)
+
+
+def write_table(table, filename, index=False):
+    if os.path.splitext(filename)[1].lower() == '.parquet':
+        table.to_parquet(filename, index=index)
+    else:
+        table.to_csv(filename, index=index)
@@ -0,0 +1,157 @@
+import logging
+import networkx as nx
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+FEE_QUALITIES = ('border_crossing', 'port_fee') # Edges whose cost comes from the border cost file
+
+
+# Directed network stored as arrays
+#---------------------------------------------------
+class Network:
+    # Node i is (x[i], y[i], iso[i]) and edge e goes from tail[e] to
+    #  head[e], with its length, quality, iso3 and cost in the arrays of
+    #  the same name. Nodes and edges are kept in the order they were
+    #  first added, like networkx does, so results match the graph this
+    #  replaces. Adding an edge that already exists overwrites its values.
+    def __init__(self):
+        self.x = np.empty(0, dtype=np.float64)
+        self.y = np.empty(0, dtype=np.float64)
+        self.iso = np.empty(0, dtype=object)
+        self.tail = np.empty(0, dtype=np.int64)
+        self.head = np.empty(0, dtype=np.int64)
+        self.length = np.empty(0, dtype=np.float64)
+        self.quality = np.empty(0, dtype=object)
+        self.iso3 = np.empty(0, dtype=object)
+        self.cost = np.empty(0, dtype=np.float64)
+        self._node_index = {}
+
+    def __getstate__(self):
+        # The node lookup is rebuilt on load instead of being pickled
+        state = self.__dict__.copy()
+        state['_node_index'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._node_index = {node: i for i, node in enumerate(self.nodes)}
+
+    @property
+    def nodes(self):
+        return list(zip(self.x.tolist(), self.y.tolist(), self.iso.tolist()))
+
+    def node(self, i):
+        return (float(self.x[i]), float(self.y[i]), self.iso[i])
+
+    def number_of_nodes(self):
+        return len(self.x)
+
+    def number_of_edges(self):
+        return len(self.tail)
+
+    def add_nodes(self, nodes):
+        # Returns the IDs of the nodes, adding the ones that are new
+        ids = np.empty(len(nodes), dtype=np.int64)
+        new = []
+        for k, node in enumerate(nodes):
+            i = self._node_index.get(node)
+            if i is None:
+                i = self._node_index[node] = len(self.x) + len(new)
+                new.append(node)
+            ids[k] = i
+        if new:
+            x, y, iso = zip(*new)
+            self.x = np.concatenate([self.x, np.array(x, dtype=np.float64)])
+            self.y = np.concatenate([self.y, np.array(y, dtype=np.float64)])
+            self.iso = np.concatenate([self.iso, np.array(iso, dtype=object)])
+        return ids
+
+    def node_ids(self, nodes):
+        # IDs of nodes that must already be in the network
+        missing = [node for node in nodes if node not in self._node_index]
+        if missing:
+            raise KeyError('{} node(s) not in the network, e.g. {}'.format(len(missing), missing[0]))
+        return np.array([self._node_index[node] for node in nodes], dtype=np.int64)
+
+    def add_edges(self, tails, heads, length, quality, iso3, cost=np.nan):
+        # tails and heads are lists of nodes, the rest lists or scalars
+        self.add_edges_by_id(self.add_nodes(tails), self.add_nodes(heads), length, quality, iso3, cost)
+
+    def add_edges_by_id(self, tails, heads, length, quality, iso3, cost=np.nan):
+        n = len(tails)
+        self.tail = np.concatenate([self.tail, tails])
+        self.head = np.concatenate([self.head, heads])
+        for name, values, dtype in [('length', length, np.float64), ('quality', quality, object),
+                ('iso3', iso3, object), ('cost', cost, np.float64)]:
+            column = np.empty(n, dtype=dtype)
+            column[:] = values
+            setattr(self, name, np.concatenate([getattr(self, name), column]))
+        self._drop_repeated_edges()
+
+    def _drop_repeated_edges(self):
+        # An edge added again keeps its first position and its last values
+        key = self.tail * max(1, len(self.x)) + self.head
+        _, first = np.unique(key, return_index=True)
+        if len(first) == len(key):
+            return
+        _, last = np.unique(key[::-1], return_index=True)
+        last = len(key) - 1 - last
+        order = np.argsort(first)
+        first, last = first[order], last[order]
+        self.tail, self.head = self.tail[first], self.head[first]
+        for name in ['length', 'quality', 'iso3', 'cost']:
+            setattr(self, name, getattr(self, name)[last])
+
+    def first_out_iso3(self, ids=None):
+        # iso3 of the first edge added out of each node
+        tails, first = np.unique(self.tail, return_index=True)
+        iso3 = np.full(len(self.x), None, dtype=object)
+        iso3[tails] = self.iso3[first]
+        return iso3 if ids is None else iso3[ids]
+
+    def is_fee(self):
+        # Qualities mix numbers and strings, so no np.isin
+        return np.logical_or.reduce([self.quality == quality for quality in FEE_QUALITIES])
+
+    def fee_edges(self):
+        # Fee edges as (u, v) node pairs, in the order of cost[is_fee()]
+        fee = self.is_fee()
+        return [(self.node(u), self.node(v)) for u, v in zip(self.tail[fee], self.head[fee])]
+
+    def fee_costs(self, edges):
+        # Current cost of each fee edge (u, v) in edges
+        fee = np.flatnonzero(self.is_fee())
+        position = dict(zip(self.fee_edges(), fee))
+        return self.cost[[position[edge] for edge in edges]]
+
+    def out_edges(self, ids):
+        # Positions of the edges leaving the nodes in ids
+        return np.flatnonzero(np.isin(self.tail, ids))
+
+    def csr_edges(self, keep=None):
+        # Edges in the order of the entries of to_csr(keep=keep)
+        edges = np.arange(len(self.tail)) if keep is None else np.flatnonzero(keep)
+        return edges[np.argsort(self.tail[edges], kind='stable')]
+
+    def to_csr(self, weight='cost', keep=None):
+        # Same as routing.compile_csr on the networkx graph. keep is an
+        #  optional boolean mask of the edges to include.
+        edges = self.csr_edges(keep)
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(self.tail[edges], minlength=len(self.x)))])
+        csr = sparse.csr_matrix((getattr(self, weight)[edges], self.head[edges].astype(np.int32), indptr),
+            shape=(len(self.x), len(self.x)))
+        logger.info('Compiled CSR graph: {} nodes, {} edges.'.format(len(self.x), len(edges)))
+        return self.nodes, self._node_index, csr
+
+    def to_networkx(self):
+        # Only for the steps that still need a networkx graph
+        nodes = self.nodes
+        G = nx.DiGraph()
+        G.add_nodes_from(nodes)
+        G.add_edges_from((nodes[u], nodes[v], {'length': length, 'quality': quality, 'iso3': iso3, 'cost': cost})
+            for u, v, length, quality, iso3, cost in zip(self.tail.tolist(), self.head.tolist(),
+                self.length.tolist(), self.quality.tolist(), self.iso3.tolist(), self.cost.tolist()))
+        return G
+#---------------------------------------------------
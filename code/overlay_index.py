@@ -0,0 +1,104 @@
+import logging
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from routing import dijkstra_columns
+
+logger = logging.getLogger(__name__)
+
+
+# Routing index for sweeps that only change border and port fees
+#---------------------------------------------------
+class OverlayIndex:
+    # Without the fee edges (border crossings, port transfers) the network
+    #  falls apart into one part per country plus the sea. The index keeps
+    #  the fixed costs inside each part, between the city nodes (targets)
+    #  and the ends of the fee edges (boundary nodes):
+    #
+    #    tt[i, j]  target i -> target j    tb[i, k]  target i -> boundary k
+    #    bb[k, l]  boundary k -> boundary l    bt[k, j]  boundary k -> target j
+    #
+    #  A path that crosses a border goes target -> boundary, then over fee
+    #  edges and fixed paths between boundary nodes, then boundary ->
+    #  target. So for new fees only the small boundary graph has to be
+    #  routed, and the rest is array operations (like customizable route
+    #  planning, with the parts as cells). Costs can differ from plain
+    #  Dijkstra in the last digits, since they are added in another order.
+    def __init__(self, target_nodes, boundary_nodes, fee_edges, tt, tb, bb, bt, target_part, boundary_part):
+        self.target_nodes = target_nodes
+        self.boundary_nodes = boundary_nodes
+        self.fee_edges = fee_edges
+        self.tt, self.tb, self.bb, self.bt = tt, tb, bb, bt
+        self.target_part = target_part
+        self.boundary_part = boundary_part
+
+        boundary_index = {node: k for k, node in enumerate(boundary_nodes)}
+        self.fee_tails = np.array([boundary_index[u] for u, v in fee_edges], dtype=np.int64)
+        self.fee_heads = np.array([boundary_index[v] for u, v in fee_edges], dtype=np.int64)
+        self.parts = [(np.flatnonzero(target_part == part), np.flatnonzero(boundary_part == part))
+            for part in np.unique(boundary_part)]
+
+    @classmethod
+    def build(cls, fixed, target_nodes, fee_edges):
+        # fixed is the compiled (nodes, node_index, csr) network without
+        #  the fee edges
+        logger.info('Building overlay index on {} fee edges...'.format(len(fee_edges)))
+        nodes, node_index, csr = fixed
+
+        boundary_nodes = list(dict.fromkeys(node for edge in fee_edges for node in edge))
+        ids = np.array([node_index[node] for node in list(target_nodes) + boundary_nodes], dtype=np.int32)
+        dist = dijkstra_columns(csr, ids, ids) # Cheap, since each search stays in its own part
+        n = len(target_nodes)
+
+        parts = csgraph.connected_components(csr, directed=True, connection='weak')[1][ids]
+        logger.info('Overlay index built: {} targets, {} boundary nodes, {} parts.'.format(
+            n, len(boundary_nodes), len(np.unique(parts))))
+        return cls(list(target_nodes), boundary_nodes, list(fee_edges),
+            dist[:n, :n], dist[:n, n:], dist[n:, n:], dist[n:, :n], parts[:n], parts[n:])
+
+    def boundary_costs(self, fees):
+        # Cheapest costs between boundary nodes over fixed paths and fee
+        #  edges, for fees in the order of fee_edges
+        overlay = self.bb.copy()
+        np.fill_diagonal(overlay, np.inf)
+        np.minimum.at(overlay, (self.fee_tails, self.fee_heads), fees)
+        rows, cols = np.nonzero(np.isfinite(overlay))
+        overlay = sparse.csr_matrix((overlay[rows, cols], (rows, cols)), shape=overlay.shape) # Keeps zero fees as edges
+        return csgraph.dijkstra(overlay, directed=True)
+
+    def matrix(self, fees):
+        # Costs between all targets. Targets only reach the boundary nodes
+        #  of their own part directly, so each part is one block of rows
+        #  (leaving it) and one block of columns (arriving in it).
+        if not len(self.boundary_nodes):
+            return self.tt.copy()
+        db = self.boundary_costs(fees)
+
+        # Target -> any boundary node, over fee edges. Targets in a part
+        #  without boundary nodes (a road fragment) reach none of them.
+        to_boundary = np.full(self.tb.shape, np.inf)
+        for targets, boundary in self.parts:
+            block = np.full((len(targets), len(self.boundary_nodes)), np.inf)
+            for k in boundary:
+                np.minimum(block, self.tb[targets, k][:, None] + db[k][None, :], out=block)
+            to_boundary[targets] = block
+
+        costs = self.tt.copy()
+        for targets, boundary in self.parts:
+            block = costs[:, targets]
+            via = np.empty_like(block)
+            for k in boundary:
+                np.add(to_boundary[:, k][:, None], self.bt[k, targets][None, :], out=via)
+                np.minimum(block, via, out=block)
+            costs[:, targets] = block
+        return costs
+
+    def origin_costs(self, fees, origin_nodes, target_nodes):
+        # Yields the costs from each origin to target_nodes as an array,
+        #  for fees in the order of fee_edges
+        costs = self.matrix(np.asarray(fees, dtype=np.float64))
+        target_index = {node: i for i, node in enumerate(self.target_nodes)}
+        cols = np.array([target_index[node] for node in target_nodes], dtype=np.int64)
+        for node in origin_nodes:
+            yield costs[target_index[node], cols]
+#---------------------------------------------------
@@ -0,0 +1,384 @@
+import heapq
+import itertools
+import logging
+import multiprocessing
+import networkx as nx
+import numpy as np
+from collections import OrderedDict, deque
+from scipy import sparse
+from scipy.sparse import csgraph
+
+logger = logging.getLogger(__name__)
+
+# Max number of float64 distances held in memory per block of origins (~256 MB)
+BLOCK_SIZE = 2**25
+
+# Graph and targets for pool workers. Filled in before the pool forks, so
+#  workers inherit them instead of receiving a pickled copy per task.
+_shared = {}
+
+
+# Compile a networkx graph into integer-indexed CSR arrays
+#---------------------------------------------------
+def compile_csr(G, weight='cost'):
+    # Node i of the CSR matrix is nodes[i]. Explicit zero weights (border
+    #  crossings, ports) are kept as edges by csgraph, so nothing is lost.
+    nodes = list(G.nodes)
+    node_index = {node: i for i, node in enumerate(nodes)}
+
+    indptr = np.zeros(len(nodes)+1, dtype=np.int64)
+    indices = np.empty(G.number_of_edges(), dtype=np.int32)
+    data = np.empty(G.number_of_edges(), dtype=np.float64)
+    k = 0
+    for i, u in enumerate(nodes):
+        for v, attrs in G.adj[u].items():
+            indices[k] = node_index[v]
+            data[k] = attrs[weight]
+            k += 1
+        indptr[i+1] = k
+
+    csr = sparse.csr_matrix((data, indices, indptr), shape=(len(nodes), len(nodes)))
+    logger.info('Compiled CSR graph: {} nodes, {} edges.'.format(len(nodes), k))
+    return nodes, node_index, csr
+
+
+def reweight_csr(csr, node_index, edges, weights):
+    # Write new weights for a few edges into the compiled arrays, so a
+    #  sweep does not have to compile the graph again
+    for (u, v), weight in zip(edges, weights):
+        i, j = node_index[u], node_index[v]
+        row = slice(csr.indptr[i], csr.indptr[i+1])
+        pos = csr.indptr[i] + np.flatnonzero(csr.indices[row] == j)[0]
+        csr.data[pos] = weight
+    return csr
+#---------------------------------------------------
+
+
+# Run tasks in a forked process pool, results in task order
+#---------------------------------------------------
+def fork_map(func, tasks, workers, **shared):
+    # Falls back to a plain loop if there is only one worker or the
+    #  platform cannot fork.
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning('Cannot fork on this platform, running on a single core.')
+        workers = 1
+
+    _shared.clear()
+    _shared.update(shared)
+    try:
+        if workers <= 1:
+            for task in tasks:
+                yield func(task)
+        else:
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for result in pool.imap(func, tasks):
+                    yield result
+    finally:
+        _shared.clear()
+#---------------------------------------------------
+
+
+# Costs-only shortest paths from every origin to the target nodes
+#---------------------------------------------------
+def _csr_block(origin_ids):
+    dist = csgraph.dijkstra(_shared['csr'], directed=True, indices=origin_ids, limit=_shared['limit'])
+    return dist[:, _shared['target_ids']], np.isfinite(dist).sum(axis=1)
+
+
+def csr_origin_costs(csr, node_index, origin_nodes, target_nodes, workers=1, limit=np.inf, settled=None, routes=None):
+    # Yields one {target_node: cost} dict per origin, in order, so it can
+    #  stand in for the dicts returned by networkx. Unreachable targets,
+    #  and targets costing more than limit, get np.inf. Origins are solved
+    #  in blocks to bound memory, with at least a few blocks per worker so
+    #  the pool stays busy. The number of nodes each search settled (every
+    #  node it reached) is added to settled, if given. With routes (a
+    #  RouteParts), the shortest paths are also split into parts and
+    #  counted on each edge, see below.
+    origin_ids = np.array([node_index[node] for node in origin_nodes], dtype=np.int32)
+    target_ids = np.array([node_index[node] for node in target_nodes], dtype=np.int32)
+    block = max(1, BLOCK_SIZE // max(1, csr.shape[0]) // (1 if routes is None else ROUTE_ARRAYS))
+    if workers > 1:
+        block = max(1, min(block, len(origin_ids) // (4*workers)))
+    starts = range(0, len(origin_ids), block)
+
+    if routes is None:
+        blocks = [origin_ids[start:start+block] for start in starts]
+        results = fork_map(_csr_block, blocks, workers, csr=csr, target_ids=target_ids, limit=limit)
+    else:
+        blocks = [(start, origin_ids[start:start+block]) for start in starts]
+        results = fork_map(_csr_route_block, blocks, workers, csr=csr, target_ids=target_ids, limit=limit,
+            routes=routes, entry_keys=csr_entry_keys(csr))
+    for result in results:
+        dist, reached = result[:2]
+        if routes is not None:
+            routes.usage += result[3]
+        if settled is not None:
+            settled.extend(reached.tolist())
+        for k, row in enumerate(dist):
+            if routes is not None:
+                routes.rows.append(result[2][k])
+            yield dict(zip(target_nodes, row.tolist()))
+
+
+# Arrays of one block of origins times all nodes held at once when
+#  following shortest path trees, compared to just the distances
+ROUTE_ARRAYS = 8
+
+
+class RouteParts:
+    # What csr_origin_costs keeps from the shortest path tree of each
+    #  origin, instead of the paths themselves. entry_parts[k] splits the
+    #  weight of CSR entry k (an edge) into parts, e.g. transport and fees;
+    #  it has one nonzero column, or none. For each origin, in order, rows
+    #  gets the parts summed along the path to each target node. usage[k]
+    #  adds up origin_weights[i] * target_weights[t] over every origin i and
+    #  target node t whose path uses entry k, one column per kind of weight
+    #  (e.g. pairs of cities and the product of their GDPs).
+    def __init__(self, entry_parts, origin_weights, target_weights):
+        self.entry_parts = entry_parts
+        self.origin_weights = origin_weights
+        self.target_weights = target_weights
+        self.usage = np.zeros((len(entry_parts), target_weights.shape[1]))
+        self.rows = deque()
+
+
+def csr_entry_keys(csr):
+    # tail * n + head of every CSR entry, sorted, and the entries in that
+    #  order, to find the edge from a node's predecessor to the node
+    n = csr.shape[0]
+    keys = np.repeat(np.arange(n, dtype=np.int64), np.diff(csr.indptr)) * n + csr.indices
+    order = np.argsort(keys, kind='stable')
+    return keys[order], order
+
+
+def path_sums(pred, values):
+    # values summed over the path from the root to each node of the trees
+    #  in pred, where pred[v] is the parent of v or -1 at the roots (and
+    #  nodes not in any tree), and values[v] belongs to the edge into v.
+    #  By pointer jumping: after k rounds sums[v] covers the 2^k edges above
+    #  v, so it takes log2(depth) rounds of array operations. Columns are
+    #  gathered one at a time, which is faster than whole rows.
+    sums = [values[:, j].copy() for j in range(values.shape[1])]
+    up = pred.copy()
+    todo = np.flatnonzero(up >= 0)
+    while len(todo):
+        parent = up[todo]
+        for column in sums:
+            column[todo] += column[parent]
+        up[todo] = up[parent]
+        todo = todo[up[todo] >= 0]
+    return np.column_stack(sums)
+
+
+def subtree_sums(pred, weights, depth):
+    # weights summed over each node and all nodes below it in the trees in
+    #  pred (as in path_sums), going up one level of depth at a time
+    sums = [weights[:, j].copy() for j in range(weights.shape[1])]
+    nodes = np.flatnonzero(pred >= 0)
+    nodes = nodes[np.argsort(-depth[nodes], kind='stable')]
+    levels = np.flatnonzero(np.diff(depth[nodes])) + 1
+    for level in np.split(nodes, levels):
+        parent = pred[level]
+        for column in sums:
+            np.add.at(column, parent, column[level])
+    return np.column_stack(sums)
+
+
+def _csr_route_block(task):
+    # Shortest path trees of a block of origins as predecessor arrays. All
+    #  trees are put side by side, node v of origin k being k*n + v, so
+    #  they are followed together.
+    start, origin_ids = task
+    csr, routes, target_ids = _shared['csr'], _shared['routes'], _shared['target_ids']
+    keys, order = _shared['entry_keys']
+    dist, pred = csgraph.dijkstra(csr, directed=True, indices=origin_ids, limit=_shared['limit'], return_predecessors=True)
+    m, n = pred.shape
+
+    in_tree = pred >= 0
+    offset = (np.arange(m, dtype=np.int64) * n)[:, None]
+    entry = np.full((m, n), -1, dtype=np.int64) # CSR entry of the edge into each node
+    entry[in_tree] = order[np.searchsorted(keys, (pred.astype(np.int64)*n + np.arange(n))[in_tree])]
+    entry, in_tree = entry.ravel(), in_tree.ravel()
+    flat_pred = np.where(in_tree, (pred + offset).ravel(), -1)
+
+    # Parts of the cost to every node, plus the number of edges to it
+    values = np.zeros((m*n, routes.entry_parts.shape[1] + 1))
+    values[in_tree, :-1] = routes.entry_parts[entry[in_tree]]
+    values[in_tree, -1] = 1
+    sums = path_sums(flat_pred, values)
+    parts = sums[:, :-1].reshape(m, n, -1)[:, target_ids]
+
+    # Each edge carries the weight of every target below it
+    weights = np.zeros((m*n, routes.target_weights.shape[1]))
+    reached = np.isfinite(dist).ravel()
+    weights[reached] = np.tile(routes.target_weights, (m, 1))[reached]
+    below = subtree_sums(flat_pred, weights, sums[:, -1])
+    below *= np.repeat(routes.origin_weights[start:start+m], n, axis=0)
+    usage = np.column_stack([np.bincount(entry[in_tree], weights=below[in_tree, j], minlength=len(routes.entry_parts))
+        for j in range(below.shape[1])])
+    return dist[:, target_ids], np.isfinite(dist).sum(axis=1), parts, usage
+
+
+def nx_dijkstra(G, source, targets, limit=np.inf):
+    # Costs from source to the nodes it settles, like
+    #  nx.single_source_dijkstra_path_length, but it stops as soon as every
+    #  node in targets (a set) is settled or the rest are beyond limit
+    counter = itertools.count()
+    dist = {}
+    seen = {source: 0}
+    heap = [(0, next(counter), source)]
+    left = len(targets)
+    while heap:
+        d, _, v = heapq.heappop(heap)
+        if v in dist:
+            continue
+        dist[v] = d
+        if v in targets:
+            left -= 1
+            if left == 0:
+                break
+        for u, edge in G.succ[v].items():
+            cost = d + edge['cost']
+            if cost > limit:
+                continue
+            if u not in seen or cost < seen[u]:
+                seen[u] = cost
+                heapq.heappush(heap, (cost, next(counter), u))
+    return dist
+
+
+def _nx_origin(origin_node):
+    costs = nx_dijkstra(_shared['G'], origin_node, _shared['targets'], limit=_shared['limit'])
+    return {node: costs[node] for node in _shared['target_nodes'] if node in costs}, len(costs)
+
+
+def nx_origin_costs(G, origin_nodes, target_nodes, workers=1, limit=np.inf, settled=None):
+    # Same as csr_origin_costs, on the networkx graph, except targets
+    #  beyond limit are missing. Routing from each origin stops once all
+    #  target nodes are settled. Workers only send back the target costs.
+    targets = set(target_nodes)
+    if workers <= 1:
+        for node in origin_nodes:
+            costs = nx_dijkstra(G, node, targets, limit=limit)
+            if settled is not None:
+                settled.append(len(costs))
+            yield costs
+    else:
+        for costs, reached in fork_map(_nx_origin, origin_nodes, workers, G=G, target_nodes=target_nodes, targets=targets, limit=limit):
+            if settled is not None:
+                settled.append(reached)
+            yield costs
+#---------------------------------------------------
+
+
+# Contract chains of degree-2 nodes into single edges
+#---------------------------------------------------
+def contract_chains(G, keep, weight='cost'):
+    # Returns a smaller copy of G, with only the weight attribute, that has
+    #  the same shortest path costs between the nodes that are left. A node
+    #  that is not in keep and only links two other nodes a and b is
+    #  removed, and every a -> node -> b becomes one a -> b edge with the
+    #  summed weight. Dead ends are removed too. A node is kept if that
+    #  would add an edge that already exists, so parallel paths are never
+    #  merged. Costs can differ in the last digits, since weights along a
+    #  chain are added before the cost to reach it.
+    H = nx.DiGraph()
+    H.add_nodes_from(G)
+    H.add_weighted_edges_from(G.edges(data=weight), weight=weight)
+
+    stack = [node for node in H if node not in keep]
+    while stack:
+        node = stack.pop()
+        if node not in H:
+            continue
+        pred, succ = H.pred[node], H.succ[node]
+        neighbours = set(pred) | set(succ)
+        if len(neighbours) > 2 or node in neighbours:
+            continue
+
+        new_edges = [(u, v, pred[u][weight] + succ[v][weight]) for u in pred for v in succ if u != v]
+        if any(H.has_edge(u, v) for u, v, w in new_edges):
+            continue
+        H.remove_node(node)
+        H.add_weighted_edges_from(new_edges, weight=weight)
+        stack.extend(n for n in neighbours if n not in keep)
+    return H
+#---------------------------------------------------
+
+
+# Find which origins a change to the network can affect
+#---------------------------------------------------
+def changed_edges(G_base, G, weight='cost'):
+    # Edges of G that are new or cheaper than in G_base, and edges of
+    #  G_base that are gone or dearer in G
+    better = [(u, v) for u, v, cost in G.edges(data=weight)
+        if not G_base.has_edge(u, v) or cost < G_base[u][v][weight]]
+    worse = [(u, v) for u, v, cost in G_base.edges(data=weight)
+        if not G.has_edge(u, v) or cost < G[u][v][weight]]
+    return better, worse
+
+
+def dijkstra_columns(csr, source_ids, column_ids):
+    # dist[i, j] from source_ids[i] to column_ids[j], in blocks of sources
+    dist = np.empty((len(source_ids), len(column_ids)), dtype=np.float64)
+    block = max(1, BLOCK_SIZE // max(1, csr.shape[0]))
+    for start in range(0, len(source_ids), block):
+        full = csgraph.dijkstra(csr, directed=True, indices=source_ids[start:start+block])
+        dist[start:start+block] = full[:, column_ids]
+    return dist
+
+
+def rows_to_update(G_base, G, nodes, base_dist, better, worse, weight='cost', rtol=1e-9):
+    # base_dist[i, j] is the baseline cost from nodes[i] to nodes[j]. Returns
+    #  a boolean array marking the origins whose row can differ on G.
+    #
+    # A cheaper path on G has to use a changed edge, and before its first
+    #  one it only uses baseline edges, so its cost is at least
+    #  base(o, u) + new(u, t) for the tail u of that edge. A baseline path
+    #  can only get dearer if it used an edge that got dearer or was
+    #  removed, i.e. base(o, u) + w(u, v) + base(v, t) == base(o, t).
+    #  Near ties are also recalculated, so the rows that are kept are
+    #  exactly what routing on G would give. Only paths that exist (a
+    #  finite via cost) count, so origins that cannot reach a changed edge
+    #  are never marked. Checking a changed edge takes two Dijkstra runs,
+    #  so with more of them than origins all rows are calculated instead.
+    if any(node not in G for node in nodes):
+        logger.warning('Some city nodes are not in the new network, calculating all rows.')
+        return np.ones(len(nodes), dtype=bool)
+
+    base_nodes, base_index, base_csr = compile_csr(G_base, weight=weight)
+    # Tails that are new nodes can only be reached through another changed
+    #  edge, so they are skipped
+    tails = list(OrderedDict.fromkeys(u for u, v in better if u in base_index))
+    if len(tails) + len(worse) > len(nodes):
+        logger.info('{} changed edges to check for {} origins, calculating all rows.'.format(len(tails) + len(worse), len(nodes)))
+        return np.ones(len(nodes), dtype=bool)
+
+    limit = base_dist * (1 + rtol)
+    np.fill_diagonal(limit, -np.inf)
+    update = np.zeros(len(nodes), dtype=bool)
+    base_ids = np.array([base_index[node] for node in nodes], dtype=np.int32)
+    base_csr_rev = base_csr.T.tocsr()
+
+    # Paths that become cheaper
+    if tails:
+        new_nodes, new_index, new_csr = compile_csr(G, weight=weight)
+        to_tail = dijkstra_columns(base_csr_rev, np.array([base_index[u] for u in tails], dtype=np.int32), base_ids)
+        from_tail = dijkstra_columns(new_csr, np.array([new_index[u] for u in tails], dtype=np.int32),
+            np.array([new_index[node] for node in nodes], dtype=np.int32))
+        for k in range(len(tails)):
+            via = to_tail[k][:, None] + from_tail[k][None, :]
+            update |= ((via <= limit) & np.isfinite(via)).any(axis=1)
+
+    # Paths that become dearer
+    if worse:
+        tails = np.array([base_index[u] for u, v in worse], dtype=np.int32)
+        heads = np.array([base_index[v] for u, v in worse], dtype=np.int32)
+        to_tail = dijkstra_columns(base_csr_rev, tails, base_ids)
+        from_head = dijkstra_columns(base_csr, heads, base_ids)
+        for k, (u, v) in enumerate(worse):
+            via = to_tail[k][:, None] + G_base[u][v][weight] + from_head[k][None, :]
+            update |= ((via <= limit) & np.isfinite(via)).any(axis=1)
+
+    return update
+#---------------------------------------------------
@@ -0,0 +1,141 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import re
+import resource
+import sys
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Numbered step banners, e.g. '1. Reading GeoJSONs...'. Each one starts a stage.
+STAGE_PATTERN = re.compile(r'^\s*(\d+b?\. .*?)\.*$')
+
+
+def report_file(outfile):
+    # Report of a run goes next to its output, e.g. data/csv/cm.report.json
+    return os.path.splitext(outfile)[0] + '.report.json'
+
+
+# Per-stage timing and memory of a script run
+#---------------------------------------------------
+class RunReport(logging.Handler):
+    # Listens to the log, so the numbered steps the scripts already log
+    #  are the stages. For each stage it records wall and CPU time (forked
+    #  workers included once they have exited), peak memory of the process
+    #  so far, bytes read and written, and any counts given to record().
+    #  finish() writes it all as JSON. With profile, the whole run is also
+    #  profiled and the hottest functions are added to the report.
+    def __init__(self, script, argv, filename, profile=False):
+        super().__init__(level=logging.INFO)
+        self.script = script
+        self.argv = list(argv)
+        self.filename = filename
+        self.counts = {}
+        self.stages = []
+        self.settled = [] # Nodes settled by Dijkstra for each origin, filled by the routing functions
+        self.t_0 = time.perf_counter()
+        self.start('0. Starting')
+        logging.getLogger().addHandler(self)
+
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def snapshot(self):
+        times = os.times()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        io_bytes = read_io()
+        return {
+            'wall': time.perf_counter(),
+            'cpu': times.user + times.system + times.children_user + times.children_system,
+            'peak_rss_mb': usage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10), # Bytes on macOS, KB on Linux
+            'read_bytes': io_bytes.get('rchar'),
+            'write_bytes': io_bytes.get('wchar'),
+            }
+
+    def start(self, name):
+        # Ends the current stage and starts the next one
+        now = self.snapshot()
+        if self.stages:
+            self.end_stage(now)
+        self.stages.append({'stage': name, 'counts': {}, '_start': now})
+
+    def end_stage(self, now):
+        stage = self.stages[-1]
+        start = stage.pop('_start')
+        stage['seconds'] = now['wall'] - start['wall']
+        stage['cpu_seconds'] = now['cpu'] - start['cpu']
+        stage['peak_rss_mb'] = now['peak_rss_mb']
+        for key in ['read_bytes', 'write_bytes']:
+            stage[key] = None if now[key] is None else now[key] - start[key]
+
+    def emit(self, record):
+        if record.levelno != logging.INFO:
+            return
+        stage = STAGE_PATTERN.match(record.getMessage())
+        if stage:
+            self.start(stage.group(1))
+
+    def record(self, **counts):
+        # Counts (nodes, edges, cities...) for the current stage and the run
+        self.stages[-1]['counts'].update(counts)
+        self.counts.update(counts)
+
+    def settled_summary(self):
+        if not self.settled:
+            return None
+        settled = np.array(self.settled, dtype=np.float64)
+        return {'origins': len(settled), 'total': int(settled.sum()), 'mean': settled.mean(),
+            'median': np.median(settled), 'max': int(settled.max())}
+
+    def finish(self, status='done'):
+        logging.getLogger().removeHandler(self)
+        self.end_stage(self.snapshot())
+        report = {
+            'script': self.script,
+            'argv': self.argv,
+            'status': status,
+            'seconds': time.perf_counter() - self.t_0,
+            'peak_rss_mb': max(stage['peak_rss_mb'] for stage in self.stages),
+            'counts': self.counts,
+            'settled_per_origin': self.settled_summary(),
+            'stages': self.stages,
+            }
+        if self.profiler is not None:
+            self.profiler.disable()
+            report['profile'] = hot_functions(self.profiler)
+            self.profiler.dump_stats(os.path.splitext(self.filename)[0] + '.prof')
+
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with open(self.filename, 'w') as f:
+            json.dump(report, f, indent=2, default=float)
+        logger.info('Run report written to {}.'.format(self.filename))
+        return report
+#---------------------------------------------------
+
+
+def read_io():
+    # Bytes this process has read and written, on Linux
+    try:
+        with open('/proc/self/io') as f:
+            return {key: int(value) for key, value in (line.split(':') for line in f)}
+    except OSError:
+        return {}
+
+
+def hot_functions(profiler, n=25):
+    # The n functions with the most time spent in them (not counting the
+    #  functions they call)
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, line, name), (calls, _, own, cumulative, _) in stats.stats.items():
+        rows.append({'function': '{}:{}({})'.format(os.path.basename(filename), line, name),
+            'calls': calls, 'seconds': own, 'cumulative_seconds': cumulative})
+    return sorted(rows, key=lambda row: row['seconds'], reverse=True)[:n]
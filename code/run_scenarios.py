@@ -0,0 +1,230 @@
+import argparse
+import logging
+import os
+import runpy
+import sys
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+import numpy as np # Imported here so every stage shares them
+import pandas as pd
+import networkx as nx
+import scipy.sparse.csgraph
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser() # Runs the whole study from a scenario manifest
+parser.add_argument('--manifest', '-m', help='Give scenario manifest location', type=str, default='parameters/scenarios.csv')
+parser.add_argument('--jobs', '-j', help='Number of stages to run at the same time', type=int, default=1)
+parser.add_argument('--engine', '-e', help='Routing engine for the cost matrices', choices=['networkx', 'csr'], default='networkx')
+parser.add_argument('--workers', '-w', help='Number of processes for each cost matrix', type=int, default=1)
+parser.add_argument('--force', '-f', help='Run every stage, even if its outputs are up to date', action='store_true')
+parser.add_argument('--dry_run', '-n', help='Only show which stages would run', action='store_true')
+args = parser.parse_args()
+
+# 0. Set file names
+#---------------------------------------------------
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+CITIES_CSV = 'data/csv/cities.csv'
+CACHE_DIR = 'data/cache' # Same as the get_cost_matrix.py default
+NETWORK_FILES = ['data/geojson/sea_links.geojson', 'data/geojson/ports.geojson', CITIES_CSV]
+COST_PARAMETERS = ['parameters/transport_costs.csv', 'parameters/transport_speeds.csv',
+    'parameters/other_cost_parameters.csv', 'parameters/tariffs.csv']
+MA_PARAMETERS = ['parameters/market_access_parameters.csv']
+DEFAULTS = {
+    'road_file': 'data/geojson/roads.geojson',
+    'bcost_file': 'parameters/border_costs.csv',
+    }
+#---------------------------------------------------
+
+
+# 1. Read the manifest
+#---------------------------------------------------
+def read_manifest():
+    # One row per scenario: name, road_file, bcost_file, time, harris,
+    #  baseline (name of the scenario to compare with), cost_matrix and
+    #  market_access (output files). Blank files take the defaults.
+    logger.info('1. Reading manifest {}...'.format(args.manifest))
+    scenarios = pd.read_csv(args.manifest, dtype=str).fillna('')
+    for column, default in DEFAULTS.items():
+        scenarios[column] = scenarios[column].replace('', default)
+    for flag in ['time', 'harris']:
+        scenarios[flag] = scenarios[flag].str.lower().isin(['1', 'true', 'yes'])
+    return scenarios.set_index('name', drop=False)
+
+
+def compare_outfile(file_a, file_b):
+    # Same name compare_outputs.py gives its output
+    return 'output/compare_' + \
+        file_a.split('/')[-1].split('.')[0] + '_' + file_b.split('/')[-1].split('.')[0] + '.csv'
+#---------------------------------------------------
+
+
+# 2. Turn scenarios into stages
+#---------------------------------------------------
+def group_scenarios(scenarios):
+    # Scenarios on the same roads file that only differ in border costs
+    #  share one network, so they go into one cost stage that builds it
+    #  once (get_cost_matrix.py -s). Road scenarios routed against a
+    #  baseline on another roads file (-B) get a stage of their own.
+    groups = {}
+    for name, s in scenarios.iterrows():
+        baseline = s['baseline']
+        if baseline and scenarios.loc[baseline, 'road_file'] != s['road_file']:
+            groups[name] = [name]
+        else:
+            groups.setdefault((s['road_file'], s['time'], s['harris']), []).append(name)
+    return list(groups.values())
+
+
+def scenario_file(scenarios, names):
+    # Border cost scenarios for get_cost_matrix.py -s. Only rewritten when
+    #  it changes, so the stage is not rerun for nothing.
+    filename = os.path.join(CACHE_DIR, 'scenarios_{}.csv'.format(names[0]))
+    text = scenarios.loc[names, ['cost_matrix', 'bcost_file']].rename(columns={'cost_matrix': 'outfile'}) \
+        .assign(tariff_file='').to_csv(index=False)
+    if not args.dry_run and (not os.path.exists(filename) or open(filename).read() != text):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(text)
+    return filename
+
+
+def make_stages(scenarios):
+    # Each stage runs one script. deps are the stages that must finish
+    #  first. Cost matrices on the same roads file wait for the first one,
+    #  which builds and caches the network, and that one waits for the
+    #  very first cost matrix, which may write the city matches.
+    logger.info('2. Planning stages...')
+    stages = {}
+    first_cost = None
+    network_builder = {}
+    groups = group_scenarios(scenarios)
+    cost_stage = {member: 'cost:' + names[0] for names in groups for member in names}
+
+    for names in groups:
+        name, s = names[0], scenarios.loc[names[0]]
+        argv = ['-o', s['cost_matrix'], '-r', s['road_file'], '-b', s['bcost_file'],
+            '-e', args.engine, '-w', str(args.workers)]
+        argv += ['-t'] if s['time'] else []
+        argv += ['-harris'] if s['harris'] else []
+        inputs = [s['road_file']] + list(dict.fromkeys(scenarios.loc[names, 'bcost_file'])) + NETWORK_FILES + COST_PARAMETERS
+        deps = []
+
+        if len(names) > 1:
+            argv += ['-s', scenario_file(scenarios, names)]
+            inputs.append(argv[-1])
+
+        if s['road_file'] in network_builder:
+            deps.append(network_builder[s['road_file']])
+        else:
+            if first_cost is not None:
+                deps.append(first_cost)
+            network_builder[s['road_file']] = 'cost:' + name
+            first_cost = first_cost or 'cost:' + name
+
+        baseline = s['baseline']
+        if baseline and scenarios.loc[baseline, 'road_file'] != s['road_file']:
+            # Only recalculate the rows the changed roads can affect
+            argv += ['-B', scenarios.loc[baseline, 'road_file']]
+            deps.append(cost_stage[baseline])
+
+        stages['cost:' + name] = {
+            'script': os.path.join(CODE_DIR, 'get_cost_matrix.py'), 'argv': argv,
+            'inputs': inputs, 'outputs': scenarios.loc[names, 'cost_matrix'].tolist(), 'deps': deps}
+
+    for name, s in scenarios.iterrows():
+        stages['ma:' + name] = {
+            'script': os.path.join(CODE_DIR, 'get_ma.py'),
+            'argv': ['-i', s['cost_matrix'], '-o', s['market_access']] + (['-harris'] if s['harris'] else []),
+            'inputs': [s['cost_matrix'], CITIES_CSV] + MA_PARAMETERS,
+            'outputs': [s['market_access']], 'deps': [cost_stage[name]]}
+
+    for name, s in scenarios.iterrows():
+        if s['baseline']:
+            file_a, file_b = scenarios.loc[s['baseline'], 'market_access'], s['market_access']
+            stages['compare:' + name] = {
+                'script': os.path.join(CODE_DIR, 'compare_outputs.py'), 'argv': ['-a', file_a, '-b', file_b],
+                'inputs': [file_a, file_b], 'outputs': [compare_outfile(file_a, file_b)],
+                'deps': ['ma:' + s['baseline'], 'ma:' + name]}
+
+    for stage in stages.values():
+        stage['deps'] = list(dict.fromkeys(stage['deps']))
+    logger.info('{} stages for {} scenarios.'.format(len(stages), len(scenarios)))
+    return stages
+
+
+def is_up_to_date(stage):
+    # Like make: every output exists and is newer than every input
+    if args.force or not all(os.path.exists(f) for f in stage['outputs']):
+        return False
+    inputs = [os.path.getmtime(f) for f in stage['inputs'] if os.path.exists(f)]
+    return min(os.path.getmtime(f) for f in stage['outputs']) >= max(inputs, default=0)
+#---------------------------------------------------
+
+
+# 3. Run stages
+#---------------------------------------------------
+def run_stage(name, stage):
+    # Runs in a forked process, which already has the libraries loaded.
+    #  The script runs as if it had been called from the command line.
+    sys.argv = [stage['script']] + stage['argv']
+    logger.info('Starting {}: {}'.format(name, ' '.join(['python', 'code/' + os.path.basename(stage['script'])] + stage['argv'])))
+    runpy.run_path(stage['script'], run_name='__main__')
+
+
+def run_stages(stages):
+    # Starts every stage whose dependencies are done, up to args.jobs at a
+    #  time. Stages whose dependencies failed are not run.
+    logger.info('3. Running stages on {} job(s)...'.format(args.jobs))
+    context = multiprocessing.get_context('fork')
+    pending = dict(stages)
+    running = {}
+    status = {}
+    t_0 = time.time()
+
+    while pending or running:
+        for name in list(pending):
+            if len(running) >= args.jobs:
+                break
+            deps = pending[name]['deps']
+            if any(status.get(dep) == 'failed' or status.get(dep) == 'not run' for dep in deps):
+                status[name] = 'not run'
+                del pending[name]
+            elif all(dep in status for dep in deps):
+                stage = pending.pop(name)
+                if is_up_to_date(stage) and not any(status[dep] == 'would run' for dep in deps):
+                    status[name] = 'up to date'
+                elif args.dry_run:
+                    status[name] = 'would run'
+                if name in status:
+                    logger.info('{}: {}'.format(name, status[name]))
+                    continue
+                process = context.Process(target=run_stage, args=(name, stage), name=name)
+                process.start()
+                running[process.sentinel] = (name, process, time.time())
+
+        if not running:
+            if pending and all(any(dep not in status for dep in stage['deps']) for stage in pending.values()):
+                raise ValueError('Stages depend on each other in a loop: {}'.format(list(pending)))
+            continue
+
+        for sentinel in wait(list(running)):
+            name, process, t_start = running.pop(sentinel)
+            process.join()
+            status[name] = 'done' if process.exitcode == 0 else 'failed'
+            logger.info('{}: {} in {:.1f}m'.format(name, status[name], (time.time() - t_start)/60))
+
+    logger.info('All stages finished in {:.1f}m.'.format((time.time() - t_0)/60))
+    return status
+#---------------------------------------------------
+
+
+scenarios = read_manifest()
+stages = make_stages(scenarios)
+status = run_stages(stages)
+for name in stages:
+    logger.info('{:<40} {}'.format(name, status[name]))
+if any(s == 'failed' or s == 'not run' for s in status.values()):
+    sys.exit(1)
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+from scipy import spatial
+
+
+# Spatial index over the nodes of one network layer
+#---------------------------------------------------
+class NodeIndex:
+    # The KD-tree is built once and answers queries for many points at a
+    #  time. ids are the layer's nodes in the network, in the order they
+    #  were added, so results match building a tree from the list of
+    #  layer nodes for every point.
+    def __init__(self, G, ids):
+        self.G = G
+        self.ids = ids
+        self.nodes = [G.node(i) for i in ids]
+        self.xy = np.column_stack([G.x[ids], G.y[ids]]) # Ignore country
+        self.iso = G.iso[ids]
+        self.tree = spatial.cKDTree(self.xy)
+        self._max_quality = None
+
+    @property
+    def max_quality(self):
+        # Highest quality among the edges leaving each node
+        if self._max_quality is None:
+            edges = self.G.out_edges(self.ids)
+            quality = pd.Series(self.G.quality[edges]).groupby(self.G.tail[edges]).max()
+            self._max_quality = quality.reindex(self.ids).to_numpy()
+        return self._max_quality
+
+    def nearest(self, points):
+        idx = self.tree.query(points)[1]
+        return [self.nodes[i] for i in idx]
+
+    def highest_quality_within(self, points, iso3s, r=0.05, k=500):
+        # For each point, the closest of the best quality nodes of its own
+        #  country within r (0.05 degrees = ~5 km). If there are none,
+        #  just the closest node of any country.
+        idx = self.tree.query(points, k=k, distance_upper_bound=r)[1]
+        closest = self.nearest(points)
+
+        matches = []
+        for row, iso3, fallback in zip(idx, iso3s, closest):
+            row = row[row < len(self.nodes)] # Since the result is padded with placeholder value if fewer than k are found
+            row = row[self.iso[row] == iso3] # Make sure nodes are within the point's country
+            if not len(row):
+                matches.append(fallback)
+                continue
+            quality = self.max_quality[row]
+            best_quality = max(0, quality.max())
+            matches.append(self.nodes[row[np.flatnonzero(quality == best_quality)[0]]])
+        return matches
+#---------------------------------------------------